@@ -10,15 +10,15 @@ from .pins import pins_bp
 from .stream import stream_bp
 from .calls import calls_bp
 from .webhooks import webhooks_bp
-from .utils import process_cors_headers, cleaner
-from threading import Thread
+from .uploads import uploads_bp
+from .utils import process_cors_headers, compress_response, set_list_etag
 
 api_bp=Blueprint("API", __name__)
 
 @api_bp.after_request
 def add_cors_headers(resp):
     process_cors_headers(resp)
-    return resp
+    return compress_response(set_list_etag(resp))
 
 api_bp.register_blueprint(auth_bp)
 api_bp.register_blueprint(channels_bp)
@@ -31,5 +31,4 @@ api_bp.register_blueprint(pins_bp)
 api_bp.register_blueprint(stream_bp)
 api_bp.register_blueprint(calls_bp)
 api_bp.register_blueprint(webhooks_bp)
-
-Thread(target=cleaner, daemon=True).start()
+api_bp.register_blueprint(uploads_bp)
@@ -2,13 +2,12 @@ from flask import Blueprint, request, jsonify
 from utils import version, dev_mode
 from .utils import (
     make_json_error, logged_in, pass_db, validate_request_data, sliding_window_rate_limiter,
-    public_key_open, get_challenge, timestamp, challenges, challenges_lock,
+    public_key_open, user_public_key, get_challenge, check_challenge, hash_passkey, check_passkey, timestamp, challenges,
     regex_first_group_encrypted, browser_regex, device_regex, rsa_encrypt,
-    get_channel_last_message_seq, hash_token
+    get_channel_last_message_seq, hash_token, list_versions
 )
 from utils import generate
 from db import SQLite
-import bcrypt
 import re
 from utils import config, RED, colored_log
 from .stream import channel_added, member_join
@@ -64,30 +63,24 @@ def join_invite(db, id, invite_code):
 @sliding_window_rate_limiter(limit=20, window=60, user_limit=10)
 @validate_request_data({"id": {"len": 20}, "solve": {"len": 20}})
 def solve():
-    with challenges_lock:
-        if request.form["id"] not in challenges: return make_json_error(400, "Invalid challenge ID")
-        if challenges[request.form["id"]]["expire"]<timestamp():
-            del challenges[request.form["id"]]
-            return make_json_error(400, "Invalid challenge ID")
-        hashed_challenge=challenges[request.form["id"]]["hashed"]
-        logged_in_at=challenges[request.form["id"]].get("logged_in_at")
-        new="new" in challenges[request.form["id"]]
-        reset_passkey="reset_passkey" in challenges[request.form["id"]]
-        if new:
-            public_key_text=challenges[request.form["id"]]["public"]
-            username=challenges[request.form["id"]]["username"]
-        elif reset_passkey:
-            user_id=challenges[request.form["id"]]["user_id"]
-        else: id=challenges[request.form["id"]]["id"]
-        del challenges[request.form["id"]]
-    if not bcrypt.checkpw(request.form["solve"].encode(), hashed_challenge.encode()): return make_json_error(401, "Challenge failed")
+    challenge=challenges.pop(request.form["id"])
+    if not challenge: return make_json_error(400, "Invalid challenge ID")
+    logged_in_at=challenge.get("logged_in_at")
+    new="new" in challenge
+    reset_passkey="reset_passkey" in challenge
+    if new:
+        public_key_text=challenge["public"]
+        username=challenge["username"]
+    elif reset_passkey: user_id=challenge["user_id"]
+    else: id=challenge["id"]
+    if not check_challenge(request.form["id"], request.form["solve"], challenge["digest"]): return make_json_error(401, "Challenge failed")
     db=SQLite()
     if new:
         public_key, error_resp=public_key_open(public_key_text)
         if error_resp: return error_resp
         id=generate()
         passkey=generate()
-        hashed_passkey=bcrypt.hashpw(passkey.encode(), bcrypt.gensalt()).decode()
+        hashed_passkey=hash_passkey(passkey)
         try:
             db.insert_data("users", {"id": id, "username": username, "passkey": hashed_passkey, "public_key": public_key_text, "created_at": timestamp()})
         except Exception as e:
@@ -98,16 +91,16 @@ def solve():
             if invite_error: colored_log(RED, "ERROR", invite_error)
     elif reset_passkey:
         new_passkey=generate()
-        hashed_passkey=bcrypt.hashpw(new_passkey.encode(), bcrypt.gensalt()).decode()
+        hashed_passkey=hash_passkey(new_passkey)
         db.update_data("users", {"passkey": hashed_passkey}, {"id": user_id})
         user_public=db.execute_raw_sql("SELECT public_key FROM users WHERE id=?", (user_id,))[0]["public_key"]
-        public_key, error_resp=public_key_open(user_public)
+        public_key, error_resp=user_public_key(user_id, user_public)
         if error_resp: return error_resp
         id=user_id
     else:
         public_key_data=db.execute_raw_sql("SELECT public_key FROM users WHERE id=?", (id,))
         if not public_key_data: return make_json_error(400, "User not found")
-        public_key, error_resp=public_key_open(public_key_data[0]["public_key"])
+        public_key, error_resp=user_public_key(id, public_key_data[0]["public_key"])
         if error_resp: return error_resp
     if not reset_passkey:
         if "User-Agent" in request.headers:
@@ -116,6 +109,7 @@ def solve():
         else: browser=device=None
         session=generate(50)
         db.insert_data("session", {"user": id, "token_hash": hash_token(session), "id": generate(), "browser": browser, "device": device, "logged_in_at": logged_in_at or timestamp(), "next_challenge": timestamp()+3600})
+        list_versions.bump(("sessions", id))
     db.close()
     if reset_passkey: return jsonify({"passkey": new_passkey, "success": True})
     return jsonify({"session": session, "success": True, **(({"passkey": passkey} if new else {}))})
@@ -138,8 +132,8 @@ def signup(db:SQLite):
     db.close()
     public_key, error_resp=public_key_open()
     if error_resp: return error_resp
-    id, challenge_hash, challenge_enc=get_challenge(public_key)
-    with challenges_lock: challenges[id]={"new": True, "username": request.form["username"], "hashed": challenge_hash, "expire": timestamp()+60, "public": request.form["public"]}
+    id, challenge_digest, challenge_enc=get_challenge(public_key)
+    challenges.put(id, {"new": True, "username": request.form["username"], "digest": challenge_digest, "public": request.form["public"]}, 60)
     return jsonify({"id": id, "challenge": challenge_enc, "success": True})
 
 @auth_bp.route("/login", methods=["POST"])
@@ -150,13 +144,12 @@ def login(db:SQLite):
     user=db.select_data("users", ["id", "passkey", "public_key"], {"username": request.form["username"]})
     db.close()
     if not user: return make_json_error(401, "Invalid login details")
-    if not bcrypt.checkpw(request.form["passkey"].encode(), user[0]["passkey"].encode()): return make_json_error(401, "Invalid login details")
+    if not check_passkey(request.form["passkey"], user[0]["passkey"]): return make_json_error(401, "Invalid login details")
     if request.form["public"]!=user[0]["public_key"]: return make_json_error(401, "Public key doesn't match")
-    public_key, error_resp=public_key_open()
+    public_key, error_resp=user_public_key(user[0]["id"], user[0]["public_key"])
     if error_resp: return error_resp
-    id, challenge_hash, challenge_enc=get_challenge(public_key)
-    id=generate()
-    with challenges_lock: challenges[id]={"id": user[0]["id"], "hashed": challenge_hash, "expire": timestamp()+60}
+    id, challenge_digest, challenge_enc=get_challenge(public_key)
+    challenges.put(id, {"id": user[0]["id"], "digest": challenge_digest}, 60)
     return jsonify({"id": id, "challenge": challenge_enc, "success": True})
 
 @auth_bp.route("/reset-passkey", methods=["POST"])
@@ -167,8 +160,8 @@ def reset_passkey(db:SQLite, id):
     user_public_data=db.execute_raw_sql("SELECT public_key FROM users WHERE id=?", (id,))
     if not user_public_data: return make_json_error(400, "User not found")
     if request.form["public"]!=user_public_data[0]["public_key"]: return make_json_error(401, "Public key doesn't match")
-    public_key, error_resp=public_key_open()
+    public_key, error_resp=user_public_key(id, user_public_data[0]["public_key"])
     if error_resp: return error_resp
-    id, challenge_hash, challenge_enc=get_challenge(public_key)
-    with challenges_lock: challenges[id]={"reset_passkey": True, "user_id": id, "hashed": challenge_hash, "expire": timestamp()+60}
-    return jsonify({"id": id, "challenge": challenge_enc, "success": True})
+    challenge_id, challenge_digest, challenge_enc=get_challenge(public_key)
+    challenges.put(challenge_id, {"reset_passkey": True, "user_id": id, "digest": challenge_digest}, 60)
+    return jsonify({"id": challenge_id, "challenge": challenge_enc, "success": True})
@@ -1,7 +1,7 @@
 from flask import Blueprint, request, jsonify
 from .utils import (
     make_json_error, logged_in, sliding_window_rate_limiter, timestamp, get_args_int,
-    perm, has_permission, get_pagination_params
+    perm, has_permission, get_pagination_params, list_versions
 )
 from db import SQLite
 
@@ -55,6 +55,7 @@ def ban_member(db:SQLite, id, channel_id, target_username):
         if has_permission(target_permissions, perm.owner, channel_permissions): return make_json_error(403, "Cannot ban owners")
         if has_permission(target_permissions, perm.admin, channel_permissions) and not has_permission(admin_permissions, perm.owner, channel_permissions): return make_json_error(403, "Cannot ban admins unless you are an owner")
         db.delete_data("members", {"user_id": target_user_id, "channel_id": channel_id})
+        list_versions.bump(("members", channel_id), ("channel", channel_id))
     if perm_data.get("existing_ban"): return make_json_error(409, "User is already banned")
     reason=request.form.get("reason", "").strip()[:100] if "reason" in request.form else None
     db.insert_data("bans", {"user_id": target_user_id, "channel_id": channel_id, "banned_by": id, "banned_at": timestamp(), "reason": reason})
@@ -2,13 +2,13 @@ import re
 import json
 from flask import Blueprint, request, jsonify
 from .utils import (
-    make_json_error, logged_in, sliding_window_rate_limiter, timestamp, handle_pfp,
+    make_json_error, logged_in, sliding_window_rate_limiter, timestamp, handle_pfp, staged_uploads,
     create_dm_id, perm, has_permission, validate_request_data,
-    check_user_channel_limit, get_channel_last_message_seq
+    check_user_channel_limit, get_channel_last_message_seq, read_cursors, list_versions, not_modified
 )
 from utils import generate
 from .stream import channel_added, channel_edited, channel_deleted, member_join, member_leave, emit, dm_unhide
-from utils import config
+from utils import config, colored_log, RED
 from db import SQLite
 
 channels_bp=Blueprint("channels", __name__)
@@ -17,6 +17,12 @@ channels_bp=Blueprint("channels", __name__)
 @logged_in()
 @sliding_window_rate_limiter(limit=100, window=60, user_limit=50)
 def channels(db:SQLite, id):
+    # Unread counts below read message_reads, a failed write stays queued for read_cursor_flusher and the list is served anyway
+    try: read_cursors.flush(id)
+    except Exception as e: colored_log(RED, "ERROR", f"Read cursor flush failed: {e}")
+    if list_versions.enabled:
+        channel_ids=sorted(row["channel_id"] for row in db.execute_raw_sql("SELECT channel_id FROM members WHERE user_id=? AND hidden IS NULL", (id,)))
+        if resp:=not_modified(id, ("channels", id), ("profiles",), *[("channel", channel_id) for channel_id in channel_ids]): return resp
     user_channels=db.execute_raw_sql("""
         SELECT c.id, c.type,
                CASE WHEN c.type=1 THEN COALESCE(other_u.display_name, other_u.username) ELSE c.name END as name,
@@ -47,6 +53,7 @@ def channels(db:SQLite, id):
                        'edited_at', last_msg.edited_at,
                        'signature', last_msg.signature,
                        'signed_timestamp', last_msg.signed_timestamp,
+                       'verified', json(CASE last_msg.verified WHEN 1 THEN 'true' WHEN 0 THEN 'false' END),
                        'nonce', last_msg.nonce,
                         'user',
                             json_object(
@@ -57,9 +64,9 @@ def channels(db:SQLite, id):
                        'attachments', (
                            SELECT json_group_array(json_object(
                                'id', am.file_id,
-                               'filename', f.filename,
+                               'filename', COALESCE(am.filename, f.filename),
                                'size', f.size,
-                               'mimetype', f.mimetype,
+                               'mimetype', COALESCE(am.mimetype, f.mimetype),
                                'encrypted', am.encrypted,
                                'iv', am.iv
                            ))
@@ -94,6 +101,7 @@ def channels(db:SQLite, id):
                 last_message_data["user"]=None
                 last_message_data["signature"]=None
                 last_message_data["signed_timestamp"]=None
+                last_message_data["verified"]=None
             channel["last_message"]=last_message_data
         if not has_permission(user_permissions, perm.manage_permissions, channel_permissions):
             del channel["channel_permissions"]
@@ -106,6 +114,7 @@ def channels(db:SQLite, id):
 @channels_bp.route("/channels", methods=["POST"])
 @logged_in()
 @sliding_window_rate_limiter(limit=20, window=300, user_limit=10)
+@staged_uploads("pfp")
 def channel_creation(db:SQLite, id):
     if config["instance"]["disable_channel_creation"]: return make_json_error(403, "Channel creation is disabled")
     error_resp=check_user_channel_limit(db, id)
@@ -241,6 +250,7 @@ def channel_creation(db:SQLite, id):
 @channels_bp.route("/channel/<string:channel_id>", methods=["DELETE", "PATCH"])
 @logged_in()
 @sliding_window_rate_limiter(limit=50, window=60, user_limit=20)
+@staged_uploads("pfp")
 def channels_management(db:SQLite, id, channel_id):
     if request.method=="PATCH":
         perm_data=db.get_permission_data(id, channel_id)
@@ -1,7 +1,7 @@
 from flask import Blueprint, request, jsonify
 from .utils import (
     make_json_error, logged_in, sliding_window_rate_limiter, timestamp,
-    has_permission, perm
+    has_permission, perm, channel_state
 )
 from utils import generate
 from db import SQLite
@@ -19,14 +19,10 @@ def channel_key_status(db:SQLite, id, channel_id):
     if not channel_data: return make_json_error(404, "Channel not found")
     if channel_data[0]["type"]==3: return make_json_error(400, "Broadcast channels don't use E2EE")
     if not has_permission(member_data[0]["permissions"], perm.send_messages, channel_data[0]["permissions"]): return make_json_error(403, "You don't have permission to send messages to view current keys in this channel")
-    current_key_info=db.execute_raw_sql(
-        "SELECT cki.key_id, expires_at FROM channels_keys_info cki "
-        "WHERE cki.channel_id = ? ORDER BY cki.seq DESC LIMIT 1",
-        (channel_id,)
-    )
+    current_key_info=channel_state.current_key(db, channel_id)
     if not current_key_info: return jsonify({"key_id": None})
-    if current_key_info[0]["expires_at"]<timestamp(True): return jsonify({"key_id": None})
-    return jsonify({"key_id": current_key_info[0]["key_id"]})
+    if current_key_info[1]<timestamp(True): return jsonify({"key_id": None})
+    return jsonify({"key_id": current_key_info[0]})
 
 @keys_bp.route("/channel/<string:channel_id>/key", methods=["POST"])
 @logged_in()
@@ -53,10 +49,12 @@ def store_channel_keys(db:SQLite, id, channel_id):
     for username in members:
         if username not in user_keys: return make_json_error(400, "User missing from keys")
     key_id=generate()
+    expires_at=timestamp(True)+86400000
     with db:
-        db.insert_data("channels_keys_info", {"key_id": key_id, "channel_id": channel_id, "by": id, "timestamp": timestamp(), "expires_at": timestamp(True)+86400000})
+        key_seq=db.insert_data("channels_keys_info", {"key_id": key_id, "channel_id": channel_id, "by": id, "timestamp": timestamp(), "expires_at": expires_at})
         for username, encrypted_key in user_keys.items():
             db.insert_data("channels_keys", {"id": key_id, "channel_id": channel_id, "user_id": user_ids[username], "key": encrypted_key})
+    channel_state.key_rotated(channel_id, key_seq, key_id, expires_at)
     return jsonify({"key_id": key_id, "success": True}), 201
 
 @keys_bp.route("/key/<string:key_id>")
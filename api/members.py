@@ -1,7 +1,7 @@
 from flask import Blueprint, request, jsonify
 from .utils import (
     make_json_error, logged_in, sliding_window_rate_limiter,
-    perm, has_permission, get_pagination_params
+    perm, has_permission, get_pagination_params, not_modified
 )
 from .stream import member_leave, member_perms_changed
 from db import SQLite
@@ -20,6 +20,7 @@ def members(db:SQLite, id, channel_id):
     channel_data=perm_data["channel_data"]
     channel_permissions=channel_data[0]["permissions"]
     if channel_data[0]["type"]==3 and not (has_permission(user_permissions, perm.manage_members, channel_permissions) or has_permission(user_permissions, perm.manage_permissions, channel_permissions)): return make_json_error(403, "You don't have permission to view members")
+    if resp:=not_modified(id, ("members", channel_id), ("profiles",)): return resp
     pb_mode="pb" in request.args
     if pb_mode:
         if channel_data[0]["type"]==3:
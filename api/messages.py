@@ -1,12 +1,13 @@
-from flask import Blueprint, request, jsonify
+from flask import Blueprint, request, jsonify, g
 import json
 from .utils import (
     make_json_error, logged_in, sliding_window_rate_limiter,
     timestamp, perm, has_permission, validate_request_data,
-    get_file_size_chunked
+    ingest_file, staged_uploads, get_args_int, message_cache, channel_state, read_cursors, reusable_files
 )
 from utils import generate
-from .stream import message_sent, message_edited, message_deleted, dm_unhide
+from .stream import message_sent, messages_sent, message_edited, message_deleted, dm_unhide
+from .signatures import queue_signature_check
 from utils import config
 from db import SQLite
 import os
@@ -18,6 +19,78 @@ messages_bp=Blueprint("messages", __name__)
 
 os.makedirs(config["data_dir"]["attachments"], exist_ok=True)
 
+# History requests filtered by any of these always go to the database
+window_filters=("user_id", "before", "after", "before_message_id", "after_message_id")
+
+def latest_channel_messages(db:SQLite, user_id, channel_ids):
+    """Latest message id of each of the channels the user is a member of, None for channels without messages"""
+    return {row["channel_id"]: row["message_id"] for row in db.execute_raw_sql(f"SELECT m.channel_id, (SELECT id FROM messages WHERE channel_id=m.channel_id ORDER BY seq DESC LIMIT 1) AS message_id FROM members m WHERE m.user_id=? AND m.channel_id IN ({", ".join("?"*len(channel_ids))})", [user_id, *channel_ids])}
+
+def author_hidden(member):
+    """Broadcast channel members who can't send or manage members only see messages without their author"""
+    return member["type"]==3 and not (
+        has_permission(member["permissions"], perm.send_messages, member["channel_permissions"])
+        or has_permission(member["permissions"], perm.manage_members, member["channel_permissions"])
+        or has_permission(member["permissions"], perm.manage_permissions, member["channel_permissions"])
+    )
+
+def message_query(hide_author, with_seq=False):
+    if hide_author:
+        return [
+            f"SELECT {"m.seq, " if with_seq else ""}m.content, m.id, m.key, m.iv, m.timestamp, m.edited_at, m.replied_to, m.nonce, m.webhook_id, ",
+            "NULL AS user, ",
+            "NULL AS signature, ",
+            "NULL AS signed_timestamp, ",
+            "NULL AS verified, ",
+            "(SELECT json_group_array(json_object(",
+            "   'id', am.file_id, ",
+            "   'filename', COALESCE(am.filename, f.filename), ",
+            "   'size', f.size, ",
+            "   'mimetype', COALESCE(am.mimetype, f.mimetype), ",
+            "   'encrypted', am.encrypted, ",
+            "   'iv', am.iv",
+            ")) FROM attachment_message am ",
+            "   JOIN files f ON am.file_id = f.id ",
+            "   WHERE am.message_id = m.id) AS attachments ",
+            "FROM messages m ",
+            "WHERE m.channel_id = ? AND m.seq > ?"
+        ]
+    return [
+        f"SELECT {"m.seq, " if with_seq else ""}m.content, m.id, m.key, m.iv, m.timestamp, m.edited_at, m.replied_to, m.nonce, m.webhook_id, ",
+        "json_object(",
+        "  'username', CASE WHEN m.user_id='0' THEN NULL ELSE u.username END, ",
+        "  'display', CASE WHEN m.user_id='0' THEN m.webhook_name ELSE u.display_name END, ",
+        "  'pfp', CASE WHEN m.user_id='0' THEN m.webhook_pfp ELSE u.pfp END",
+        ") AS user, ",
+        "m.signature, ",
+        "m.signed_timestamp, ",
+        "m.verified, ",
+        "(SELECT json_group_array(json_object(",
+        "   'id', am.file_id, ",
+        "   'filename', COALESCE(am.filename, f.filename), ",
+        "   'size', f.size, ",
+        "   'mimetype', COALESCE(am.mimetype, f.mimetype), ",
+        "   'encrypted', am.encrypted, ",
+        "   'iv', am.iv",
+        ")) FROM attachment_message am ",
+        "   JOIN files f ON am.file_id = f.id ",
+        "   WHERE am.message_id = m.id) AS attachments ",
+        "FROM messages m ",
+        "JOIN users u ON m.user_id = u.id ",
+        "WHERE m.channel_id = ? AND m.seq > ?"
+    ]
+
+def parse_message_rows(messages):
+    for msg in messages:
+        msg["user"]=json.loads(msg["user"]) if msg["user"] else None
+        msg["attachments"]=[{**a, "encrypted": bool(a["encrypted"])} for a in json.loads(msg["attachments"])]
+        if msg["verified"] is not None: msg["verified"]=bool(msg["verified"])
+    return messages
+
+def load_message_window(db:SQLite, channel_id):
+    rows=parse_message_rows(db.execute_raw_sql(" ".join(message_query(False, with_seq=True)+["ORDER BY m.seq DESC LIMIT ?"]), (channel_id, 0, message_cache.window+1)))
+    return [(row.pop("seq"), row) for row in rows]
+
 @messages_bp.route("/channel/<string:channel_id>/messages")
 @logged_in()
 @sliding_window_rate_limiter(limit=200, window=60, user_limit=100)
@@ -30,16 +103,8 @@ def channel_messages(db:SQLite, id, channel_id):
     """, (id, channel_id))
     if not member_channel_data: return make_json_error(404, "Channel not found")
     data=member_channel_data[0]
-    user_permissions=data["permissions"]
     member_message_seq=data["message_seq"]
-    channel_permissions=data["channel_permissions"]
-    hide_author=(
-        data["type"]==3 and not (
-            has_permission(user_permissions, perm.send_messages, channel_permissions)
-            or has_permission(user_permissions, perm.manage_members, channel_permissions)
-            or has_permission(user_permissions, perm.manage_permissions, channel_permissions)
-        )
-    )
+    hide_author=author_hidden(data)
     limit=int(request.args.get("limit", 50))
     offset=int(request.args.get("offset", 0))
     before_messages=int(request.args.get("before_messages", 0))
@@ -47,49 +112,15 @@ def channel_messages(db:SQLite, id, channel_id):
     if limit<1: limit=1
     if before_messages<0: before_messages=0
     if before_messages>100: before_messages=100
-    if hide_author:
-        sql_parts=[
-            "SELECT m.content, m.id, m.key, m.iv, m.timestamp, m.edited_at, m.replied_to, m.nonce, m.webhook_id, ",
-            "NULL AS user, ",
-            "NULL AS signature, ",
-            "NULL AS signed_timestamp, ",
-            "(SELECT json_group_array(json_object(",
-            "   'id', am.file_id, ",
-            "   'filename', f.filename, ",
-            "   'size', f.size, ",
-            "   'mimetype', f.mimetype, ",
-            "   'encrypted', am.encrypted, ",
-            "   'iv', am.iv",
-            ")) FROM attachment_message am ",
-            "   JOIN files f ON am.file_id = f.id ",
-            "   WHERE am.message_id = m.id) AS attachments ",
-            "FROM messages m ",
-            "WHERE m.channel_id = ? AND m.seq > ?"
-        ]
-    else:
-        sql_parts=[
-            "SELECT m.content, m.id, m.key, m.iv, m.timestamp, m.edited_at, m.replied_to, m.nonce, m.webhook_id, ",
-            "json_object(",
-            "  'username', CASE WHEN m.user_id='0' THEN NULL ELSE u.username END, ",
-            "  'display', CASE WHEN m.user_id='0' THEN m.webhook_name ELSE u.display_name END, ",
-            "  'pfp', CASE WHEN m.user_id='0' THEN m.webhook_pfp ELSE u.pfp END",
-            ") AS user, ",
-            "m.signature, ",
-            "m.signed_timestamp, ",
-            "(SELECT json_group_array(json_object(",
-            "   'id', am.file_id, ",
-            "   'filename', f.filename, ",
-            "   'size', f.size, ",
-            "   'mimetype', f.mimetype, ",
-            "   'encrypted', am.encrypted, ",
-            "   'iv', am.iv",
-            ")) FROM attachment_message am ",
-            "   JOIN files f ON am.file_id = f.id ",
-            "   WHERE am.message_id = m.id) AS attachments ",
-            "FROM messages m ",
-            "JOIN users u ON m.user_id = u.id ",
-            "WHERE m.channel_id = ? AND m.seq > ?"
-        ]
+    total_limit=limit+before_messages
+    if message_cache.max_channels and offset>=0 and not any(arg in request.args for arg in window_filters):
+        window, complete=message_cache.get(channel_id) or message_cache.load(channel_id, lambda: load_message_window(db, channel_id))
+        visible=[m for m in window if m[0]>member_message_seq]
+        # The window holds the newest messages, it answers the request when it covers the page or everything the member can see
+        if complete or len(visible)<len(window) or len(visible)>=offset+total_limit:
+            g.cache_compressed=True
+            return jsonify([m[2] if hide_author else m[1] for m in visible[offset:offset+total_limit]])
+    sql_parts=message_query(hide_author)
     params=[channel_id, member_message_seq]
     if "user_id" in request.args:
         if request.args["user_id"]!="0" and len(request.args["user_id"])!=20: return make_json_error(400, "Invalid user_id parameter, error: length")
@@ -114,22 +145,89 @@ def channel_messages(db:SQLite, id, channel_id):
         sql_parts.append("AND m.seq > (SELECT seq FROM messages WHERE id=? AND channel_id=?)")
         params.extend([request.args["after_message_id"], channel_id])
     sql_parts.append("ORDER BY m.seq DESC LIMIT ? OFFSET ?")
-    total_limit=limit+before_messages
     params.extend([total_limit, offset])
-    messages=db.execute_raw_sql(" ".join(sql_parts), params)
+    return jsonify(parse_message_rows(db.execute_raw_sql(" ".join(sql_parts), params)))
+
+def _fts_query(query):
+    terms=[]
+    for term in query.split():
+        prefix=term.endswith("*")
+        term=term.rstrip("*")
+        if not term: continue
+        terms.append('"'+term.replace('"', '""')+'"'+("*" if prefix else ""))
+    return " ".join(terms)
+
+@messages_bp.route("/channel/<string:channel_id>/messages/search")
+@logged_in()
+@sliding_window_rate_limiter(limit=60, window=60, user_limit=30)
+@validate_request_data({"q": {"minlen": 1, "maxlen": 200}}, source="args")
+def search_messages(db:SQLite, id, channel_id):
+    member_channel_data=db.execute_raw_sql("""
+        SELECT m.permissions, m.message_seq, c.type, c.permissions as channel_permissions
+        FROM members m
+        JOIN channels c ON m.channel_id=c.id
+        WHERE m.user_id=? AND m.channel_id=?
+    """, (id, channel_id))
+    if not member_channel_data: return make_json_error(404, "Channel not found")
+    data=member_channel_data[0]
+    if data["type"]!=3: return make_json_error(400, "Search is only supported in broadcast channels")
+    hide_author=author_hidden(data)
+    match=_fts_query(request.args["q"])
+    if not match: return make_json_error(400, "Invalid q parameter, error: no search terms")
+    limit=get_args_int("limit", 25)
+    if isinstance(limit, tuple): return limit
+    if limit>100: limit=100
+    if limit<1: limit=1
+    params=[match, channel_id, data["message_seq"]]
+    cursor_sql=""
+    if "cursor" in request.args:
+        try:
+            cursor_score, cursor_seq=request.args["cursor"].split(":")
+            cursor_score=float(cursor_score)
+            cursor_seq=int(cursor_seq)
+        except ValueError: return make_json_error(400, "Invalid cursor parameter")
+        cursor_sql="AND (hits.score>? OR (hits.score=? AND hits.seq<?))"
+        params.extend([cursor_score, cursor_score, cursor_seq])
+    params.append(limit)
+    messages=db.execute_raw_sql(f"""
+        SELECT m.content, m.id, m.key, m.iv, m.timestamp, m.edited_at, m.replied_to, m.nonce, m.webhook_id,
+        {"NULL" if hide_author else "json_object('username', CASE WHEN m.user_id='0' THEN NULL ELSE u.username END, 'display', CASE WHEN m.user_id='0' THEN m.webhook_name ELSE u.display_name END, 'pfp', CASE WHEN m.user_id='0' THEN m.webhook_pfp ELSE u.pfp END)"} AS user,
+        {"NULL" if hide_author else "m.signature"} AS signature,
+        {"NULL" if hide_author else "m.signed_timestamp"} AS signed_timestamp,
+        {"NULL" if hide_author else "m.verified"} AS verified,
+        (SELECT json_group_array(json_object('id', am.file_id, 'filename', COALESCE(am.filename, f.filename), 'size', f.size, 'mimetype', COALESCE(am.mimetype, f.mimetype), 'encrypted', am.encrypted, 'iv', am.iv))
+         FROM attachment_message am JOIN files f ON am.file_id = f.id WHERE am.message_id = m.id) AS attachments,
+        hits.score, hits.seq
+        FROM (
+            SELECT rowid AS seq, bm25(messages_fts) AS score
+            FROM messages_fts
+            WHERE messages_fts MATCH ? AND channel_id=?
+        ) hits
+        JOIN messages m ON m.seq=hits.seq
+        JOIN users u ON m.user_id = u.id
+        WHERE m.seq > ? {cursor_sql}
+        ORDER BY hits.score ASC, hits.seq DESC
+        LIMIT ?
+    """, params)
+    next_cursor=f"{messages[-1]['score']!r}:{messages[-1]['seq']}" if len(messages)==limit else None
     for msg in messages:
+        del msg["score"], msg["seq"]
         msg["user"]=json.loads(msg["user"]) if msg["user"] else None
         msg["attachments"]=[{**a, "encrypted": bool(a["encrypted"])} for a in json.loads(msg["attachments"])]
-    return jsonify(messages)
+        if msg["verified"] is not None: msg["verified"]=bool(msg["verified"])
+    return jsonify({"messages": messages, "cursor": next_cursor, "success": True})
 
 @messages_bp.route("/channel/<string:channel_id>/messages", methods=["POST"])
 @logged_in()
 @sliding_window_rate_limiter(limit=100, window=60, user_limit=50)
 @validate_request_data({"content": {}, "timestamp": {}, "signature": {}})
+@staged_uploads("attachment")
 def sending_messages(db:SQLite, id, channel_id):
     files=request.files.getlist("files")
+    upload_ids=list(dict.fromkeys(request.form.getlist("uploads")))
+    file_ids=request.form.getlist("file_ids")
     msg=request.form["content"].replace("\r\n", "\n").replace("\r", "\n").strip()
-    has_files=any(file.filename for file in files)
+    has_files=any(file.filename for file in files) or bool(upload_ids) or bool(file_ids)
     if (not has_files and not msg): return make_json_error(400, "content or files required")
     replied_to=request.form.get("replied_to")
     try: signed_timestamp=int(request.form["timestamp"])
@@ -158,14 +256,9 @@ def sending_messages(db:SQLite, id, channel_id):
     if data["type"]!=3:
         if "key" not in request.form or "iv" not in request.form: return make_json_error(400, "key and iv is required in non-broadcast channels")
         key=request.form["key"]
-        latest_user_key=db.execute_raw_sql(
-            "SELECT cki.key_id, expires_at FROM channels_keys_info cki "
-            "WHERE cki.channel_id=? "
-            "ORDER BY cki.seq DESC LIMIT 1",
-            (channel_id,)
-        )
-        if not latest_user_key or latest_user_key[0]["expires_at"]<timestamp(True): return make_json_error(403, "No encryption key available")
-        if key!=latest_user_key[0]["key_id"]: return make_json_error(400, "Invalid or outdated encryption key")
+        latest_user_key=channel_state.current_key(db, channel_id)
+        if not latest_user_key or latest_user_key[1]<timestamp(True): return make_json_error(403, "No encryption key available")
+        if key!=latest_user_key[0]: return make_json_error(400, "Invalid or outdated encryption key")
         if len(request.form["iv"])!=16: return make_json_error(400, "Invalid iv parameter, error: length")
         iv=request.form["iv"]
     nonce=request.form.get("nonce")
@@ -181,36 +274,56 @@ def sending_messages(db:SQLite, id, channel_id):
             attachment_iv=meta.get("iv")
             if encrypted and not attachment_iv: return make_json_error(400, "iv required when encrypted=true")
             if encrypted and len(attachment_iv)!=16: return make_json_error(400, "Invalid iv length for attachment")
+    uploads=[]
+    if upload_ids:
+        uploads=db.execute_raw_sql(f"""
+            SELECT u.id, u.filename, COALESCE(u.mimetype, f.mimetype) AS mimetype, u.encrypted, u.iv, f.id AS file_id, f.size
+            FROM uploads u
+            JOIN files f ON f.id=u.file_id
+            WHERE u.user_id=? AND u.id IN ({", ".join("?"*len(upload_ids))})
+        """, [id, *upload_ids])
+        if len(uploads)!=len(upload_ids): return make_json_error(400, "Upload not found or not finalized")
+    # Files found through /files/known, already stored so nothing is uploaded, only attached unencrypted under the sender's filename
+    known_refs={}
+    for item in file_ids:
+        try: ref=json.loads(item)
+        except: return make_json_error(400, "Invalid file_ids format")
+        if not isinstance(ref, dict) or not all(isinstance(ref.get(key), str) for key in ("id", "hash", "filename")) or not 1<=len(ref["filename"])<=255: return make_json_error(400, "Invalid file, id, hash and filename are required")
+        known_refs[ref["id"]]=ref
+    if sum(1 for file in files if file.filename)+len(upload_ids)+len(known_refs)>config["messages"]["max_attachments"]: return make_json_error(400, "Too many attachments")
+    known_files=[]
+    if known_refs:
+        known_files=[file for file in reusable_files(db, id, "id", list(known_refs)) if file["hash"]==known_refs[file["id"]]["hash"]]
+        if len(known_files)!=len(known_refs): return make_json_error(400, "File not found")
     message_id=generate()
     sent_at=timestamp(True)
-    db.insert_data("messages", {"id": message_id, "channel_id": channel_id, "user_id": id, "content": msg, "key": key, "iv": iv, "timestamp": sent_at, "replied_to": replied_to, "signature": signature, "signed_timestamp": signed_timestamp, "nonce": nonce})
-    if db.exists("message_reads", {"user_id": id, "channel_id": channel_id}): db.update_data("message_reads", {"last_message_id": message_id, "read_at": sent_at}, {"user_id": id, "channel_id": channel_id})
-    else: db.insert_data("message_reads", {"user_id": id, "channel_id": channel_id, "last_message_id": message_id, "read_at": sent_at})
+    channel_state.message_inserted(channel_id, db.insert_data("messages", {"id": message_id, "channel_id": channel_id, "user_id": id, "content": msg, "key": key, "iv": iv, "timestamp": sent_at, "replied_to": replied_to, "signature": signature, "signed_timestamp": signed_timestamp, "nonce": nonce}))
     attachments=[]
     for idx, file in enumerate(files):
-        if file.filename and (file.content_length is None or file.content_length <= config["max_file_size"]["attachments"]) and get_file_size_chunked(file, config["max_file_size"]["attachments"])<=config["max_file_size"]["attachments"]:
+        if file.filename and (file.content_length is None or file.content_length<=config["max_file_size"]["attachments"]):
             meta=attachments_meta[idx] if idx<len(attachments_meta) else {}
             encrypted=meta.get("encrypted", False)
             attachment_iv=meta.get("iv")
-            temp_path=os.path.join(config["data_dir"]["attachments"], f"temp_{generate()}")
-            file.save(temp_path)
-            file_hash=db.calculate_file_hash(temp_path)
-            file_size=os.path.getsize(temp_path)
-            existing_file=db.select_data("files", ["id", "filename", "size", "mimetype"], {"hash": file_hash, "file_type": "attachment"})
-            if existing_file:
-                os.remove(temp_path)
-                file_id=existing_file[0]["id"]
-                file_info=existing_file[0]
-            else:
-                file_id=generate()
-                final_path=os.path.join(config["data_dir"]["attachments"], file_id)
-                os.rename(temp_path, final_path)
-                db.insert_data("files", {"id": file_id, "filename": file.filename, "hash": file_hash, "size": file_size, "mimetype": file.content_type, "file_type": "attachment"})
-                file_info={"id": file_id, "filename": file.filename, "size": file_size, "mimetype": file.content_type}
+            file_info=ingest_file(file.stream, "attachment", config["max_file_size"]["attachments"], db, file.filename, file.content_type)
+            if not file_info: continue
+            file_id=file_info["id"]
+            # A deduplicated file keeps the first uploader's name and type in files, each attachment carries its sender's own
+            mimetype=file.content_type or file_info["mimetype"]
             existing_attachment=db.select_data("attachment_message", ["file_id"], {"file_id": file_id, "message_id": message_id})
             if not existing_attachment:
-                db.insert_data("attachment_message", {"file_id": file_id, "message_id": message_id, "encrypted": 1 if encrypted else 0, "iv": attachment_iv})
-            attachments.append({"id": file_id, "filename": file.filename, "size": file_info["size"], "mimetype": file_info["mimetype"], "encrypted": bool(encrypted), "iv": attachment_iv})
+                db.insert_data("attachment_message", {"file_id": file_id, "message_id": message_id, "encrypted": 1 if encrypted else 0, "iv": attachment_iv, "filename": file.filename, "mimetype": mimetype})
+            attachments.append({"id": file_id, "filename": file.filename, "size": file_info["size"], "mimetype": mimetype, "encrypted": bool(encrypted), "iv": attachment_iv})
+    for upload in uploads:
+        if any(attachment["id"]==upload["file_id"] for attachment in attachments): continue
+        db.insert_data("attachment_message", {"file_id": upload["file_id"], "message_id": message_id, "encrypted": upload["encrypted"], "iv": upload["iv"], "filename": upload["filename"], "mimetype": upload["mimetype"]})
+        attachments.append({"id": upload["file_id"], "filename": upload["filename"], "size": upload["size"], "mimetype": upload["mimetype"], "encrypted": bool(upload["encrypted"]), "iv": upload["iv"]})
+    for file in known_files:
+        if any(attachment["id"]==file["id"] for attachment in attachments): continue
+        filename=known_refs[file["id"]]["filename"]
+        db.insert_data("attachment_message", {"file_id": file["id"], "message_id": message_id, "encrypted": 0, "iv": None, "filename": filename, "mimetype": file["mimetype"]})
+        attachments.append({"id": file["id"], "filename": filename, "size": file["size"], "mimetype": file["mimetype"], "encrypted": False, "iv": None})
+    # Each upload is attached once, the file now lives on through the message
+    if uploads: db.delete_data("uploads", {"id": [upload["id"] for upload in uploads]})
     if not msg and has_files and not attachments:
         db.delete_data("messages", {"id": message_id})
         return make_json_error(400, "Files do not meet size requirements")
@@ -229,6 +342,7 @@ def sending_messages(db:SQLite, id, channel_id):
         "attachments": attachments,
         "signature": None if hide_signature else signature,
         "signed_timestamp": None if hide_signature else signed_timestamp,
+        "verified": None,
         "nonce": nonce
     }
     if data["type"]==1:
@@ -242,10 +356,53 @@ def sending_messages(db:SQLite, id, channel_id):
             db.update_data("members", {"hidden": None}, {"user_id": other_user_id, "channel_id": channel_id})
             dm_unhide(channel_id, other_user_id, db)
 
+    read_cursors.mark(id, channel_id, message_id, sent_at)
+    if data["type"]==3: queue_signature_check(message_id, id, msg, signature, signed_timestamp)
     message_sent(channel_id, message_data, id, db)
 
     return jsonify({"message_id": message_id, "attachments": attachments, "success": True}), 201
 
+@messages_bp.route("/channel/<string:channel_id>/messages/batch", methods=["POST"])
+@logged_in()
+@sliding_window_rate_limiter(limit=20, window=60, user_limit=10)
+def sending_messages_batch(db:SQLite, id, channel_id):
+    # For bots and bridges posting into broadcast channels, permissions are checked and the fanout is done once for the whole batch
+    payload=request.get_json(silent=True)
+    if not isinstance(payload, list) or not payload: return make_json_error(400, "Invalid payload format")
+    if len(payload)>config["messages"]["max_batch_messages"]: return make_json_error(400, "Too many messages")
+    data=db.execute_raw_sql("""
+        SELECT m.permissions, c.type, c.permissions as channel_permissions
+        FROM members m
+        JOIN channels c ON m.channel_id=c.id
+        WHERE m.user_id=? AND m.channel_id=?
+    """, (id, channel_id))
+    if not data: return make_json_error(404, "Channel not found")
+    data=data[0]
+    if data["type"]!=3: return make_json_error(400, "Batch sending is only available in broadcast channels")
+    if not has_permission(data["permissions"], perm.send_messages, data["channel_permissions"]): return make_json_error(403, "No permission to send messages")
+    current_time=timestamp()
+    messages=[]
+    for item in payload:
+        if not isinstance(item, dict) or not isinstance(item.get("content"), str) or not isinstance(item.get("signature"), str) or not isinstance(item.get("timestamp"), int): return make_json_error(400, "Each message needs content, timestamp and signature")
+        if (item.get("replied_to") is not None and not isinstance(item["replied_to"], str)) or (item.get("nonce") is not None and not isinstance(item["nonce"], str)): return make_json_error(400, "Invalid replied_to or nonce")
+        msg=item["content"].replace("\r\n", "\n").replace("\r", "\n").strip()
+        if not msg: return make_json_error(400, "content required")
+        if len(msg)>config["messages"]["max_message_length"]: return make_json_error(400, "Message too long")
+        if abs(current_time-item["timestamp"])>config["messages"]["signature_timestamp_window"]: return make_json_error(400, "Timestamp is invalid")
+        messages.append({"id": generate(), "content": msg, "replied_to": item.get("replied_to"), "signature": item["signature"], "signed_timestamp": item["timestamp"], "nonce": item.get("nonce")})
+    replied_to={message["replied_to"] for message in messages if message["replied_to"]}
+    if replied_to and len(db.select_data("messages", ["id"], {"id": list(replied_to), "channel_id": channel_id}))!=len(replied_to): return make_json_error(400, "replied_to message not found in this channel")
+    sent_at=timestamp(True)
+    with db:
+        db.execute_many("INSERT INTO messages (id, channel_id, user_id, content, timestamp, replied_to, signature, signed_timestamp, nonce) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", [(message["id"], channel_id, id, message["content"], sent_at, message["replied_to"], message["signature"], message["signed_timestamp"], message["nonce"]) for message in messages])
+        last_seq=db.execute_raw_sql("SELECT last_insert_rowid() AS seq")[0]["seq"]
+    channel_state.message_inserted(channel_id, last_seq)
+    read_cursors.mark(id, channel_id, messages[-1]["id"], sent_at)
+    user_data=db.execute_raw_sql("SELECT username, display_name AS display, pfp FROM users WHERE id=?", (id,))[0]
+    for message in messages: queue_signature_check(message["id"], id, message["content"], message["signature"], message["signed_timestamp"])
+    messages_sent(channel_id, [{"id": message["id"], "content": message["content"], "key": None, "iv": None, "timestamp": sent_at, "edited_at": None, "replied_to": message["replied_to"], "user": user_data, "attachments": [], "signature": message["signature"], "signed_timestamp": message["signed_timestamp"], "verified": None, "nonce": message["nonce"]} for message in messages], id, db)
+    return jsonify({"message_ids": [message["id"] for message in messages], "success": True}), 201
+
 @messages_bp.route("/channel/<string:channel_id>/message/<string:message_id>", methods=["PATCH", "DELETE"])
 @logged_in()
 @sliding_window_rate_limiter(limit=150, window=60, user_limit=75)
@@ -274,7 +431,7 @@ def message_management(db:SQLite, id, channel_id, message_id):
         if abs(current_time-signed_timestamp)>config["messages"]["signature_timestamp_window"]: return make_json_error(400, "Timestamp is invalid")
 
         if content==data["content"] and (data["type"]==3 or request.form.get("iv")==data["iv"]): return jsonify({"success": True})
-        update_fields={"content": content, "edited_at": timestamp(True), "signature": signature, "signed_timestamp": signed_timestamp}
+        update_fields={"content": content, "edited_at": timestamp(True), "signature": signature, "signed_timestamp": signed_timestamp, "verified": None}
 
         if data["type"]!=3:
             if "iv" not in request.form: return make_json_error(400, "iv is required in non-broadcast channels")
@@ -282,12 +439,13 @@ def message_management(db:SQLite, id, channel_id, message_id):
             update_fields["iv"]=request.form["iv"]
 
         db.update_data("messages", update_fields, {"id": message_id})
+        if data["type"]==3: queue_signature_check(message_id, id, content, signature, signed_timestamp)
 
         # Get updated message data for emit
         updated_message=db.execute_raw_sql("""
-            SELECT m.id, m.content, m.key, m.iv, m.timestamp, m.edited_at, m.replied_to, m.signature, m.signed_timestamp, m.nonce, m.webhook_id,
+            SELECT m.id, m.content, m.key, m.iv, m.timestamp, m.edited_at, m.replied_to, m.signature, m.signed_timestamp, m.verified, m.nonce, m.webhook_id,
             json_object('username', CASE WHEN m.user_id='0' THEN NULL ELSE u.username END, 'display', CASE WHEN m.user_id='0' THEN m.webhook_name ELSE u.display_name END, 'pfp', CASE WHEN m.user_id='0' THEN m.webhook_pfp ELSE u.pfp END) as user,
-            (SELECT json_group_array(json_object('id', am.file_id, 'filename', f.filename, 'size', f.size, 'mimetype', f.mimetype, 'encrypted', am.encrypted, 'iv', am.iv))
+            (SELECT json_group_array(json_object('id', am.file_id, 'filename', COALESCE(am.filename, f.filename), 'size', f.size, 'mimetype', COALESCE(am.mimetype, f.mimetype), 'encrypted', am.encrypted, 'iv', am.iv))
              FROM attachment_message am JOIN files f ON am.file_id = f.id WHERE am.message_id = m.id) as attachments
             FROM messages m JOIN users u ON m.user_id = u.id WHERE m.id=?
         """, (message_id,))[0]
@@ -319,14 +477,60 @@ def message_management(db:SQLite, id, channel_id, message_id):
 @logged_in()
 @sliding_window_rate_limiter(limit=60, window=60, user_limit=30)
 def ack_message(db:SQLite, id, channel_id):
-    if not db.exists("members", {"user_id": id, "channel_id": channel_id}): return make_json_error(404, "Channel not found")
-    latest_message=db.execute_raw_sql(
-        "SELECT id FROM messages WHERE channel_id=? ORDER BY seq DESC LIMIT 1",
-        (channel_id,)
-    )
-    if not latest_message: return make_json_error(404, "No messages in channel")
-    latest_message_id=latest_message[0]["id"]
-    if db.exists("message_reads", {"user_id": id, "channel_id": channel_id}):
-        db.update_data("message_reads", {"last_message_id": latest_message_id, "read_at": timestamp(True)}, {"user_id": id, "channel_id": channel_id})
-    else: db.insert_data("message_reads", {"user_id": id, "channel_id": channel_id, "last_message_id": latest_message_id, "read_at": timestamp(True)})
+    latest_messages=latest_channel_messages(db, id, [channel_id])
+    if channel_id not in latest_messages: return make_json_error(404, "Channel not found")
+    if not latest_messages[channel_id]: return make_json_error(404, "No messages in channel")
+    read_cursors.mark(id, channel_id, latest_messages[channel_id], timestamp(True))
     return jsonify({"success": True})
+
+@messages_bp.route("/channels/ack", methods=["POST"])
+@logged_in()
+@sliding_window_rate_limiter(limit=60, window=60, user_limit=30)
+def ack_channels(db:SQLite, id):
+    channel_ids=request.get_json(silent=True)
+    if not isinstance(channel_ids, list) or not all(isinstance(channel_id, str) for channel_id in channel_ids): return make_json_error(400, "Invalid payload format")
+    if len(channel_ids)>100: return make_json_error(400, "Too many channels requested")
+    latest_messages=latest_channel_messages(db, id, channel_ids) if channel_ids else {}
+    read_at=timestamp(True)
+    for channel_id, message_id in latest_messages.items():
+        if message_id: read_cursors.mark(id, channel_id, message_id, read_at)
+    return jsonify({"success": True, "acked": {channel_id: message_id for channel_id, message_id in latest_messages.items() if message_id}, "not_found": [channel_id for channel_id in channel_ids if channel_id not in latest_messages]})
+
+@messages_bp.route("/sync", methods=["POST"])
+@logged_in()
+@sliding_window_rate_limiter(limit=120, window=60, user_limit=60)
+def sync_channels(db:SQLite, id):
+    # Maps channel ids to the cursor the last sync returned, null starts following a channel from now
+    cursors=request.get_json(silent=True)
+    if not isinstance(cursors, dict): return make_json_error(400, "Invalid payload format")
+    if len(cursors)>100: return make_json_error(400, "Too many channels requested")
+    if any(cursor is not None and (type(cursor) is not int or cursor<0) for cursor in cursors.values()): return make_json_error(400, "Invalid cursor")
+    if not cursors: return jsonify({"success": True, "channels": {}, "removed": [], "has_more": False})
+    members={row["channel_id"]: row for row in db.execute_raw_sql(f"SELECT m.channel_id, m.permissions, m.message_seq, c.type, c.permissions AS channel_permissions FROM members m JOIN channels c ON m.channel_id=c.id WHERE m.user_id=? AND m.channel_id IN ({", ".join("?"*len(cursors))})", [id, *cursors])}
+    # Read before the changes, anything committed in between has a higher seq and is picked up by the changes query
+    log=db.execute_raw_sql("SELECT COALESCE((SELECT seq FROM sqlite_sequence WHERE name='channel_changes'), 0) AS latest, COALESCE((SELECT MIN(seq)-1 FROM channel_changes), (SELECT seq FROM sqlite_sequence WHERE name='channel_changes'), 0) AS horizon")[0]
+    following={channel_id: cursor for channel_id, cursor in cursors.items() if channel_id in members and cursor is not None and cursor>=log["horizon"]}
+    max_changes=config["sync"]["max_changes"]
+    # Changes to messages from before the member joined are left out like in channel_messages, deletes and pins included
+    rows=db.execute_raw_sql(f"WITH cursors (channel_id, cursor, message_seq) AS (VALUES {", ".join(["(?, ?, ?)"]*len(following))}) SELECT cc.seq, cc.channel_id, cc.message_id, cc.type FROM cursors JOIN channel_changes cc ON cc.channel_id=cursors.channel_id AND cc.seq>cursors.cursor AND cc.message_seq>cursors.message_seq ORDER BY cc.seq LIMIT ?", [value for channel_id, cursor in following.items() for value in (channel_id, cursor, members[channel_id]["message_seq"] or 0)]+[max_changes+1]) if following else []
+    has_more=len(rows)>max_changes
+    rows=rows[:max_changes]
+    end=rows[-1]["seq"] if has_more else max(log["latest"], rows[-1]["seq"] if rows else 0)
+    # Only the latest state of each message is sent, an insert edited since is still an insert
+    content={}
+    pins={}
+    for row in rows:
+        if row["type"] in ("pin", "unpin"): pins[row["message_id"]]=row
+        elif row["type"]=="edit" and content.get(row["message_id"], {}).get("type")=="insert": content[row["message_id"]]={**row, "type": "insert"}
+        else: content[row["message_id"]]=row
+    messages={}
+    for hide_author in (False, True):
+        message_ids=[message_id for message_id, row in content.items() if row["type"]!="delete" and author_hidden(members[row["channel_id"]])==hide_author]
+        if not message_ids: continue
+        for message in parse_message_rows(db.execute_raw_sql(" ".join(message_query(hide_author)[:-1]+[f"WHERE m.id IN ({", ".join("?"*len(message_ids))})"]), message_ids)): messages[message["id"]]=message
+    channels={channel_id: {"cursor": end if channel_id in following else log["latest"], "reset": cursors[channel_id] is not None and channel_id not in following, "changes": []} for channel_id in cursors if channel_id in members}
+    for row in sorted([row for row in content.values() if row["type"]=="delete" or row["message_id"] in messages]+[row for row in pins.values() if content.get(row["message_id"], {}).get("type")!="delete"], key=lambda row: row["seq"]):
+        change={"seq": row["seq"], "type": row["type"], "message_id": row["message_id"]}
+        if row["type"] in ("insert", "edit"): change["message"]=messages[row["message_id"]]
+        channels[row["channel_id"]]["changes"].append(change)
+    return jsonify({"success": True, "channels": channels, "removed": [channel_id for channel_id in cursors if channel_id not in members], "has_more": has_more})
@@ -2,7 +2,7 @@ from flask import Blueprint, jsonify
 import json
 from .utils import (
     make_json_error, logged_in, sliding_window_rate_limiter,
-    get_pagination_params, has_permission, perm
+    get_pagination_params, has_permission, perm, list_versions, not_modified
 )
 from db import SQLite
 
@@ -31,15 +31,16 @@ def get_pinned_messages(db:SQLite, id, channel_id):
     if isinstance(pagination, tuple):
         return pagination
     page_size, offset = pagination["page_size"], pagination["offset"]
+    if resp:=not_modified(id, ("pins", channel_id), ("members", channel_id), ("profiles",)): return resp
     if hide_author:
         sql_parts=[
-            "SELECT m.content, m.id, m.key, m.iv, m.timestamp, m.edited_at, m.replied_to, m.signature, m.signed_timestamp, m.nonce, m.webhook_id, ",
+            "SELECT m.content, m.id, m.key, m.iv, m.timestamp, m.edited_at, m.replied_to, m.signature, m.signed_timestamp, m.verified, m.nonce, m.webhook_id, ",
             "NULL AS user, ",
             "(SELECT json_group_array(json_object(",
             "   'id', am.file_id, ",
-            "   'filename', f.filename, ",
+            "   'filename', COALESCE(am.filename, f.filename), ",
             "   'size', f.size, ",
-            "   'mimetype', f.mimetype, ",
+            "   'mimetype', COALESCE(am.mimetype, f.mimetype), ",
             "   'encrypted', am.encrypted, ",
             "   'iv', am.iv",
             ")) FROM attachment_message am ",
@@ -51,7 +52,7 @@ def get_pinned_messages(db:SQLite, id, channel_id):
         ]
     else:
         sql_parts=[
-            "SELECT m.content, m.id, m.key, m.iv, m.timestamp, m.edited_at, m.replied_to, m.signature, m.signed_timestamp, m.nonce, m.webhook_id, ",
+            "SELECT m.content, m.id, m.key, m.iv, m.timestamp, m.edited_at, m.replied_to, m.signature, m.signed_timestamp, m.verified, m.nonce, m.webhook_id, ",
             "json_object(",
             "  'username', CASE WHEN m.user_id='0' THEN NULL ELSE u.username END, ",
             "  'display', CASE WHEN m.user_id='0' THEN m.webhook_name ELSE u.display_name END, ",
@@ -59,9 +60,9 @@ def get_pinned_messages(db:SQLite, id, channel_id):
             ") AS user, ",
             "(SELECT json_group_array(json_object(",
             "   'id', am.file_id, ",
-            "   'filename', f.filename, ",
+            "   'filename', COALESCE(am.filename, f.filename), ",
             "   'size', f.size, ",
-            "   'mimetype', f.mimetype, ",
+            "   'mimetype', COALESCE(am.mimetype, f.mimetype), ",
             "   'encrypted', am.encrypted, ",
             "   'iv', am.iv",
             ")) FROM attachment_message am ",
@@ -78,6 +79,7 @@ def get_pinned_messages(db:SQLite, id, channel_id):
     pinned_messages=db.execute_raw_sql(" ".join(sql_parts), params)
     for msg in pinned_messages:
         msg["user"]=json.loads(msg["user"]) if msg["user"] else None
+        if msg["verified"] is not None: msg["verified"]=bool(msg["verified"])
         msg["attachments"]=[{**a, "encrypted": bool(a["encrypted"])} for a in json.loads(msg["attachments"])]
     return jsonify(pinned_messages)
 
@@ -98,6 +100,7 @@ def pin_message(db:SQLite, id, channel_id, message_id):
     except Exception as e:
         if "UNIQUE constraint failed" in str(e): return make_json_error(409, "Message is already pinned")
         raise
+    list_versions.bump(("pins", channel_id))
     return jsonify({"success": True})
 
 @pins_bp.route("/channel/<string:channel_id>/message/<string:message_id>/pin", methods=["DELETE"])
@@ -113,4 +116,5 @@ def unpin_message(db:SQLite, id, channel_id, message_id):
     if channel_data["type"]!=1 and not has_permission(user_permissions, perm.manage_messages, channel_data["permissions"]): return make_json_error(403, "You don't have manage messages permission")
     if not db.exists("messages", {"id": message_id, "channel_id": channel_id}): return make_json_error(404, "Message not found")
     if db.delete_data("message_pins", {"id": message_id})==0: return make_json_error(409, "Message is not pinned")
+    list_versions.bump(("pins", channel_id))
     return jsonify({"success": True})
@@ -0,0 +1,92 @@
+import base64
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import lru_cache
+from queue import Queue, Empty
+from db import SQLite
+from utils import config, stopping, colored_log, RED
+from .utils import message_cache, list_versions
+
+verify_queue=Queue()
+
+def signed_data(content, signed_timestamp):
+    """What clients sign for a broadcast message, this is the API contract verification relies on:
+    the UTF-8 bytes of "<timestamp>:<content>", where timestamp is the timestamp field sent with the message
+    and content is the message as stored (line endings turned into \n, surrounding whitespace stripped),
+    signed with the account key using RSA-PSS, MGF1 SHA-256, maximum salt length and SHA-256"""
+    return f"{signed_timestamp}:{content}"
+
+def queue_signature_check(message_id, user_id, content, signature, signed_timestamp):
+    """Only called for broadcast channels, elsewhere content is ciphertext and clients sign what they encrypted"""
+    if config["messages"]["verify_signatures"] and signature: verify_queue.put((message_id, user_id, signature, signed_data(content, signed_timestamp)))
+
+@lru_cache(maxsize=1024)
+def load_public_key(public_key_base64):
+    from cryptography.hazmat.primitives import serialization
+    try: return serialization.load_der_public_key(base64.b64decode(public_key_base64))
+    except Exception: return None
+
+def verify_batch(batch):
+    """Verify a list of (public_key_base64, signature, data), runs in a worker process"""
+    from .utils import rsa_verify_signature
+    results=[]
+    for public_key_base64, signature, data in batch:
+        public_key=load_public_key(public_key_base64)
+        results.append(bool(public_key) and rsa_verify_signature(public_key, signature, data))
+    return results
+
+def next_batch(batch_size):
+    batch=[verify_queue.get(timeout=1)]
+    # Give messages sent right after this one a moment to join the batch
+    try:
+        while len(batch)<batch_size: batch.append(verify_queue.get(timeout=0.05))
+    except Empty: pass
+    return batch
+
+def signature_verifier(executor):
+    workers=config["messages"]["verify_workers"]
+    while not stopping.is_set():
+        try: batch=next_batch(config["messages"]["verify_batch_size"])
+        except Empty: continue
+        try:
+            user_ids=list({user_id for _, user_id, _, _ in batch})
+            db=SQLite()
+            try: public_keys={row["id"]: row["public_key"] for row in db.execute_raw_sql(f"SELECT id, public_key FROM users WHERE id IN ({", ".join("?"*len(user_ids))})", user_ids)}
+            finally: db.close()
+            batch=[item for item in batch if item[1] in public_keys]
+            checks=[(public_keys[user_id], signature, data) for _, user_id, signature, data in batch]
+            if executor:
+                chunk_size=-(-len(checks)//workers) or 1
+                try: results=[result for chunk in executor.map(verify_batch, [checks[i:i+chunk_size] for i in range(0, len(checks), chunk_size)]) for result in chunk]
+                except BrokenProcessPool:
+                    # A worker died (e.g. killed for memory), the pool refuses all work from then on so it's replaced and this batch is verified here
+                    colored_log(RED, "ERROR", "Signature worker died, restarting the workers")
+                    executor.shutdown(wait=False, cancel_futures=True)
+                    executor=create_executor()
+                    results=verify_batch(checks)
+            else: results=verify_batch(checks)
+            # Only passes are recorded, a failure may just be a client signing something else so those stay unchecked for clients to verify
+            verified=[(message_id, signature) for (message_id, _, signature, _), result in zip(batch, results) if result]
+            if not verified: continue
+            # Matching on the signature skips messages that were edited while they waited
+            with SQLite() as db:
+                db.execute_many("UPDATE messages SET verified=1 WHERE id=? AND signature=?", verified)
+                channel_ids=[row["channel_id"] for row in db.execute_raw_sql(f"SELECT DISTINCT channel_id FROM messages WHERE id IN ({", ".join("?"*len(verified))})", [message_id for message_id, _ in verified])] if list_versions.enabled else []
+            message_cache.set_verified({message_id: (signature, True) for message_id, signature in verified})
+            list_versions.bump(*[(kind, channel_id) for channel_id in channel_ids for kind in ("channel", "pins")])
+        except Exception as e: colored_log(RED, "ERROR", f"Signature verification failed: {e}")
+
+def create_executor():
+    """Worker pool with every worker already forked, spawned workers would run main.py again"""
+    executor=ProcessPoolExecutor(max_workers=config["messages"]["verify_workers"], mp_context=multiprocessing.get_context("fork"))
+    executor.submit(int).result()
+    return executor
+
+def start_signature_verifier():
+    from threading import Thread
+    executor=None
+    # main.py calls this before any other thread exists, forking a multi-threaded process can deadlock the workers
+    # Only a pool replacing a dead one is forked later, the alternative is no worker verifying anything until a restart
+    if config["messages"]["verify_workers"] and "fork" in multiprocessing.get_all_start_methods(): executor=create_executor()
+    Thread(target=signature_verifier, args=(executor,), daemon=True).start()
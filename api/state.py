@@ -0,0 +1,171 @@
+import heapq
+import json
+import math
+import sqlite3
+import time
+from threading import Lock, local
+from utils import config
+
+def gcra(keys, tats, now):
+    """Charge every (type, key, limit, window) in keys against their theoretical arrival times, or none of them if one is exhausted.
+    Returns ((allowed, type, limit, remaining, seconds until reset), {key: new tat})"""
+    charged={}
+    results=[]
+    for kind, key, limit, window in keys:
+        interval=window/limit
+        tat=max(tats.get(key) or now, now)
+        if tat+interval-now>window: return (False, kind, limit, 0, tat-window+interval-now), {}
+        charged[key]=tat+interval
+        remaining=int((window-(tat+interval-now))/interval+1e-6)
+        results.append((True, kind, limit, remaining, tat-window+(remaining+2)*interval-now))
+    return min(results, key=lambda x: x[3]), charged
+
+def with_reset_time(result):
+    allowed, kind, limit, remaining, reset_in=result
+    return allowed, kind, limit, remaining, math.ceil(time.time()+reset_in)
+
+class RateLimiter:
+    """Rate limits kept in this process, one theoretical arrival time per key spread over lock-striped shards so updates are O(1)"""
+    def __init__(self, shards=64):
+        self.shards=[({}, Lock()) for _ in range(shards)]
+
+    def shard(self, key): return self.shards[hash(key)%len(self.shards)]
+
+    def hit(self, keys):
+        now=time.monotonic()
+        locks=[self.shards[i][1] for i in sorted({hash(key)%len(self.shards) for _, key, _, _ in keys})]
+        for lock in locks: lock.acquire()
+        try:
+            result, charged=gcra(keys, {key: self.shard(key)[0].get(key) for _, key, _, _ in keys}, now)
+            for key, tat in charged.items(): self.shard(key)[0][key]=tat
+        finally:
+            for lock in locks: lock.release()
+        return with_reset_time(result)
+
+    def cleanup(self):
+        now=time.monotonic()
+        for tats, lock in self.shards:
+            with lock:
+                for key in [k for k, tat in tats.items() if tat<=now]: del tats[key]
+
+class ChallengeShard:
+    def __init__(self):
+        self.challenges={}
+        self.expiry=[]
+        self.lock=Lock()
+        self.metrics=dict.fromkeys(["created", "used", "expired", "evicted"], 0)
+
+    def drop_oldest(self, reason):
+        # Heap entries of challenges that were already used are stale, they're skipped here
+        expire, challenge_id=heapq.heappop(self.expiry)
+        challenge=self.challenges.get(challenge_id)
+        if challenge and challenge[1]==expire:
+            del self.challenges[challenge_id]
+            self.metrics[reason]+=1
+
+class ChallengeStore:
+    """Login challenges waiting to be solved, kept in this process.
+    Each shard has an expiry heap so cleanup and eviction only touch what they remove, and a capacity past which the oldest challenges are dropped"""
+    def __init__(self, capacity, shards=16):
+        self.shard_capacity=max(capacity//shards, 1)
+        self.shards=[ChallengeShard() for _ in range(shards)]
+
+    def shard(self, challenge_id): return self.shards[hash(challenge_id)%len(self.shards)]
+
+    def put(self, challenge_id, data, ttl):
+        shard=self.shard(challenge_id)
+        expire=time.time()+ttl
+        with shard.lock:
+            shard.challenges[challenge_id]=(data, expire)
+            heapq.heappush(shard.expiry, (expire, challenge_id))
+            shard.metrics["created"]+=1
+            while len(shard.challenges)>self.shard_capacity: shard.drop_oldest("evicted")
+
+    def pop(self, challenge_id):
+        """Remove a challenge and return its data, None if it doesn't exist or expired"""
+        shard=self.shard(challenge_id)
+        with shard.lock:
+            challenge=shard.challenges.pop(challenge_id, None)
+            if not challenge: return None
+            if challenge[1]<time.time():
+                shard.metrics["expired"]+=1
+                return None
+            shard.metrics["used"]+=1
+        return challenge[0]
+
+    def cleanup(self):
+        now=time.time()
+        for shard in self.shards:
+            with shard.lock:
+                while shard.expiry and shard.expiry[0][0]<now: shard.drop_oldest("expired")
+
+    def stats(self):
+        stats={"outstanding": 0, "created": 0, "used": 0, "expired": 0, "evicted": 0}
+        for shard in self.shards:
+            with shard.lock:
+                stats["outstanding"]+=len(shard.challenges)
+                for k, v in shard.metrics.items(): stats[k]+=v
+        return stats
+
+class SQLiteState:
+    """Connection handling for state shared between worker processes through a WAL database, the data is disposable so it's never synced to disk"""
+    def __init__(self, path):
+        self.path=path
+        self.local=local()
+
+    def connect(self):
+        conn=getattr(self.local, "conn", None)
+        if conn is None:
+            conn=sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=OFF")
+            conn.execute("CREATE TABLE IF NOT EXISTS ratelimits (key TEXT PRIMARY KEY, tat REAL NOT NULL) WITHOUT ROWID")
+            conn.execute("CREATE TABLE IF NOT EXISTS challenges (id TEXT PRIMARY KEY, data TEXT NOT NULL, expire REAL NOT NULL) WITHOUT ROWID")
+            conn.execute("CREATE INDEX IF NOT EXISTS challenges_expire ON challenges (expire)")
+            self.local.conn=conn
+        return conn
+
+class SQLiteRateLimiter(SQLiteState):
+    """Rate limits shared between worker processes, wall clock based so they survive restarts"""
+    def hit(self, keys):
+        now=time.time()
+        conn=self.connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            tats=dict(conn.execute(f"SELECT key, tat FROM ratelimits WHERE key IN ({", ".join("?"*len(keys))})", [key for _, key, _, _ in keys]).fetchall())
+            result, charged=gcra(keys, tats, now)
+            if charged: conn.executemany("INSERT INTO ratelimits (key, tat) VALUES (?, ?) ON CONFLICT(key) DO UPDATE SET tat=excluded.tat", charged.items())
+            conn.execute("COMMIT")
+        except:
+            conn.execute("ROLLBACK")
+            raise
+        return with_reset_time(result)
+
+    def cleanup(self): self.connect().execute("DELETE FROM ratelimits WHERE tat<=?", (time.time(),))
+
+class SQLiteChallengeStore(SQLiteState):
+    """Login challenges shared between worker processes, so /solve can land on any of them"""
+    def __init__(self, path, capacity):
+        super().__init__(path)
+        self.capacity=capacity
+
+    def put(self, challenge_id, data, ttl): self.connect().execute("INSERT OR REPLACE INTO challenges (id, data, expire) VALUES (?, ?, ?)", (challenge_id, json.dumps(data), time.time()+ttl))
+
+    def pop(self, challenge_id):
+        challenge=self.connect().execute("DELETE FROM challenges WHERE id=? RETURNING data, expire", (challenge_id,)).fetchall()
+        if not challenge or challenge[0][1]<time.time(): return None
+        return json.loads(challenge[0][0])
+
+    def cleanup(self):
+        conn=self.connect()
+        conn.execute("DELETE FROM challenges WHERE expire<?", (time.time(),))
+        conn.execute("DELETE FROM challenges WHERE id IN (SELECT id FROM challenges ORDER BY expire DESC LIMIT -1 OFFSET ?)", (self.capacity,))
+
+    def stats(self): return {"outstanding": self.connect().execute("SELECT COUNT(*) FROM challenges").fetchone()[0]}
+
+if config["server"]["state"]=="sqlite":
+    rate_limiter=SQLiteRateLimiter(config["data_dir"]["state"])
+    challenges=SQLiteChallengeStore(config["data_dir"]["state"], config["server"]["max_challenges"])
+else:
+    rate_limiter=RateLimiter()
+    challenges=ChallengeStore(config["server"]["max_challenges"])
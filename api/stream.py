@@ -1,6 +1,6 @@
 from flask import Blueprint, Response, stream_with_context
 from .utils import (
-    logged_in, sliding_window_rate_limiter, timestamp, perm, has_permission
+    logged_in, sliding_window_rate_limiter, timestamp, perm, has_permission, message_cache, channel_state, list_versions
 )
 from utils import generate
 import time
@@ -13,8 +13,10 @@ stream_bp=Blueprint("stream", __name__)
 streams={}
 streams_lock=Lock()
 
-def emit(event_type, data, conditions=None):
-    """Emit event to all matching streams with thread safety"""
+def emit(event_type, data, conditions=None): emit_many([(event_type, data)], conditions)
+
+def emit_many(events, conditions=None):
+    """Emit a list of (event_type, data) to all matching streams in a single pass with thread safety"""
     with streams_lock:
         streams_to_remove=[]
         for i, stream_data in streams.items():
@@ -31,19 +33,29 @@ def emit(event_type, data, conditions=None):
                         should_send=False
                 if should_send:
                     with stream_data["lock"]:
-                        event_data={
-                            "event": event_type,
-                            "data": data,
-                            "timestamp": timestamp(True)
-                        }
-                        stream_data["pending"].append(event_data)
+                        for event_type, data in events:
+                            event_data={
+                                "event": event_type,
+                                "data": data,
+                                "timestamp": timestamp(True)
+                            }
+                            stream_data["pending"].append(event_data)
             except:
                 streams_to_remove.append(i)
         for i in streams_to_remove:
             del streams[i]
 
-def message_sent(channel_id, message_data, user_id, db):
-    """Emit message sent event"""
+def message_sent(channel_id, message_data, user_id, db): messages_sent(channel_id, [message_data], user_id, db)
+
+def messages_sent(channel_id, messages, user_id, db):
+    """Emit a message sent event for each message, looking up the channel and its members once"""
+    list_versions.bump(("channel", channel_id))
+    if message_cache.changed(channel_id):
+        # The window takes the stored rows, not the emitted ones, so cached and database history are the same
+        from .messages import message_query, parse_message_rows
+        message_ids=[message_data["id"] for message_data in messages]
+        rows=parse_message_rows(db.execute_raw_sql(" ".join(message_query(False, with_seq=True)[:-1]+[f"WHERE m.id IN ({", ".join("?"*len(message_ids))})"]), message_ids))
+        message_cache.add(channel_id, [(row.pop("seq"), row) for row in rows])
     channel_data=db.select_data("channels", ["type", "permissions"], {"id": channel_id})
     if not channel_data:
         return
@@ -69,34 +81,39 @@ def message_sent(channel_id, message_data, user_id, db):
                 regular_users.append(member_user_id)
 
         if manage_users:
-            emit("message_sent", {
+            emit_many([("message_sent", {
                 "channel_id": channel_id,
                 "message": message_data
-            }, {
+            }) for message_data in messages], {
                 "user_id": manage_users
             })
 
         if regular_users:
-            message_data_no_author=dict(message_data)
-            message_data_no_author["user"]=None
-            message_data_no_author["signature"]=None
-            message_data_no_author["signed_timestamp"]=None
-            emit("message_sent", {
-                "channel_id": channel_id,
-                "message": message_data_no_author
-            }, {
+            events=[]
+            for message_data in messages:
+                message_data_no_author=dict(message_data)
+                message_data_no_author["user"]=None
+                message_data_no_author["signature"]=None
+                message_data_no_author["signed_timestamp"]=None
+                events.append(("message_sent", {
+                    "channel_id": channel_id,
+                    "message": message_data_no_author
+                }))
+            emit_many(events, {
                 "user_id": regular_users
             })
     else:
-        emit("message_sent", {
+        emit_many([("message_sent", {
             "channel_id": channel_id,
             "message": message_data
-        }, {
+        }) for message_data in messages], {
             "channel_ids": [channel_id],
         })
 
 def message_edited(channel_id, message_data, user_id, db):
     """Emit message edited event"""
+    message_cache.update(channel_id, message_data)
+    list_versions.bump(("channel", channel_id), ("pins", channel_id))
     channel_data=db.select_data("channels", ["type", "permissions"], {"id": channel_id})
     if not channel_data:
         return
@@ -150,6 +167,8 @@ def message_edited(channel_id, message_data, user_id, db):
 
 def message_deleted(channel_id, message_id, user_id):
     """Emit message deleted event"""
+    message_cache.remove(channel_id, message_id)
+    list_versions.bump(("channel", channel_id), ("pins", channel_id))
     emit("message_deleted", {
         "channel_id": channel_id,
         "message_id": message_id
@@ -193,6 +212,7 @@ def channel_added(user_id, channel_data, db=None):
 
 def channel_edited(channel_id, channel_data, db):
     """Emit channel edited event with effective permissions per user"""
+    list_versions.bump(("channel", channel_id), ("members", channel_id))
     member_rows=db.execute_raw_sql("SELECT user_id, permissions FROM members WHERE channel_id=?", (channel_id,))
     for row in member_rows:
         user_id=row["user_id"]
@@ -237,6 +257,7 @@ def update_channel_keys_on_member_change(channel_id, db):
         "UPDATE channels_keys_info SET expires_at=0 WHERE channel_id=? AND expires_at>=?",
         (channel_id, timestamp())
     )
+    channel_state.keys_expired(channel_id)
 
 def _emit_member_event_with_channel_perms(event_type, event_data, channel_id, member_user_id, db):
     """Helper function to emit member events with permission filtering for channel type 3"""
@@ -261,6 +282,7 @@ def _emit_member_event_with_channel_perms(event_type, event_data, channel_id, me
 def member_join(channel_id, user_data, db):
     """Emit member join event and update user's channel_ids"""
     user_id=user_data["id"]
+    list_versions.bump(("channel", channel_id), ("members", channel_id))
 
     # Update channels_keys_info to expire the latest entry
     update_channel_keys_on_member_change(channel_id, db)
@@ -320,6 +342,7 @@ def member_join(channel_id, user_data, db):
 def member_leave(channel_id, user_data, db):
     """Emit member leave event and update user's channel_ids"""
     user_id=user_data["id"]
+    list_versions.bump(("channel", channel_id), ("members", channel_id))
 
     # Update channels_keys_info to expire the latest entry
     update_channel_keys_on_member_change(channel_id, db)
@@ -384,6 +407,7 @@ def member_info_changed(user_id, user_data, db):
             })
 
 def member_perms_changed(channel_id, user_id, username, permissions, db):
+    list_versions.bump(("channel", channel_id), ("members", channel_id))
     channel_data=db.select_data("channels", ["permissions"], {"id": channel_id})
     channel_permissions=channel_data[0]["permissions"] if channel_data else 0
     effective_permissions=permissions if permissions is not None else channel_permissions
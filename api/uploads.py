@@ -0,0 +1,178 @@
+from flask import Blueprint, request, jsonify
+import hashlib
+import os
+import re
+from threading import Lock
+from contextlib import contextmanager
+from werkzeug.exceptions import ClientDisconnected
+from .utils import (
+    make_json_error, logged_in, sliding_window_rate_limiter, validate_request_data,
+    timestamp, get_args_int, store_file, reusable_files, LRUCache, ingest_buffer_size
+)
+from utils import config, generate, upload_path
+from db import SQLite
+
+uploads_bp=Blueprint("uploads", __name__)
+
+# Hash state of uploads whose chunks arrived in this process, finalize rehashes the file when it's missing (restart, another worker)
+upload_hashes=LRUCache(10000)
+# upload_id -> [lock, users], a lock lives while a request for its upload holds or waits for it
+upload_locks={}
+upload_locks_lock=Lock()
+
+sha256_regex=re.compile(r"[0-9a-f]{64}")
+
+@contextmanager
+def upload_lock(upload_id):
+    """Serializes requests for one upload in this process, other workers are kept out by claim_upload"""
+    with upload_locks_lock:
+        entry=upload_locks.setdefault(upload_id, [Lock(), 0])
+        entry[1]+=1
+    try:
+        with entry[0]: yield
+    finally:
+        with upload_locks_lock:
+            entry[1]-=1
+            if not entry[1]: del upload_locks[upload_id]
+
+def claim_upload(db: SQLite, user_id, upload_id, condition, params=()):
+    """Mark the upload as being written when it matches condition, the update is atomic so only one worker gets the claim.
+    Returns the claim token or None, a worker dying mid-write leaves the upload claimed until it expires"""
+    writer=generate()
+    claimed=db.execute(f"UPDATE uploads SET writer=? WHERE id=? AND user_id=? AND writer IS NULL AND file_id IS NULL AND {condition}", (writer, upload_id, user_id, *params)).rowcount
+    db.commit()
+    return writer if claimed else None
+
+def upload_info(upload): return {"id": upload["id"], "filename": upload["filename"], "size": upload["size"], "offset": upload["received"], "finalized": upload["file_id"] is not None, "expires_at": upload["expires_at"]}
+
+def get_upload(db: SQLite, user_id, upload_id):
+    upload=db.select_data("uploads", ["id", "filename", "mimetype", "size", "received", "file_id", "expires_at"], {"id": upload_id, "user_id": user_id})
+    return upload[0] if upload else None
+
+def offset_mismatch(upload, error): return jsonify({"success": False, "error": error, "offset": upload["received"]}), 409
+
+@uploads_bp.route("/uploads", methods=["POST"])
+@logged_in()
+@sliding_window_rate_limiter(limit=60, window=60, user_limit=30)
+@validate_request_data({"filename": {"minlen": 1, "maxlen": 255}, "size": {}})
+def create_upload(db:SQLite, id):
+    try: size=int(request.form["size"])
+    except ValueError: return make_json_error(400, "Invalid size parameter")
+    if size<1: return make_json_error(400, "Invalid size parameter")
+    if size>config["max_file_size"]["attachments"]: return make_json_error(413, "File exceeds size limit")
+    encrypted=request.form.get("encrypted") in ("true", "1")
+    iv=request.form.get("iv")
+    if encrypted and not iv: return make_json_error(400, "iv required when encrypted=true")
+    if encrypted and len(iv)!=16: return make_json_error(400, "Invalid iv length for attachment")
+    if db.execute_raw_sql("SELECT COUNT(*) AS count FROM uploads WHERE user_id=?", (id,))[0]["count"]>=config["uploads"]["max_pending"]: return make_json_error(409, "Too many pending uploads")
+    upload={"id": generate(), "user_id": id, "filename": request.form["filename"], "mimetype": request.form.get("mimetype"), "size": size, "received": 0, "encrypted": int(encrypted), "iv": iv if encrypted else None, "file_id": None, "created_at": timestamp(), "expires_at": timestamp()+config["uploads"]["expire"]}
+    db.insert_data("uploads", upload)
+    return jsonify({"success": True, "upload": upload_info(upload)})
+
+@uploads_bp.route("/upload/<string:upload_id>")
+@logged_in()
+@sliding_window_rate_limiter(limit=120, window=60, user_limit=60)
+def upload_status(db:SQLite, id, upload_id):
+    upload=get_upload(db, id, upload_id)
+    if not upload: return make_json_error(404, "Upload not found")
+    return jsonify({"success": True, "upload": upload_info(upload)})
+
+@uploads_bp.route("/upload/<string:upload_id>", methods=["PUT"])
+@logged_in()
+@sliding_window_rate_limiter(limit=600, window=60, user_limit=300)
+def upload_chunk(db:SQLite, id, upload_id):
+    offset=get_args_int("offset", -1)
+    if isinstance(offset, tuple): return offset
+    with upload_lock(upload_id):
+        upload=get_upload(db, id, upload_id)
+        if not upload: return make_json_error(404, "Upload not found")
+        if upload["file_id"]: return make_json_error(409, "Upload already finalized")
+        if offset!=upload["received"]: return offset_mismatch(upload, "Offset doesn't match the uploaded size")
+        if request.content_length and offset+request.content_length>upload["size"]: return make_json_error(413, "Chunk exceeds upload size")
+        # Another worker may have passed the same offset check, only the one whose claim lands writes the range
+        writer=claim_upload(db, id, upload_id, "received=?", (offset,))
+        if not writer: return offset_mismatch(get_upload(db, id, upload_id) or upload, "Another chunk of this upload is being written")
+        cached=upload_hashes.pop(upload_id)
+        file_hash=hashlib.sha256() if offset==0 else cached[1] if cached and cached[0]==offset else None
+        received=offset
+        disconnected=False
+        try:
+            with open(upload_path(upload_id), "r+b" if offset else "wb") as f:
+                # Drop anything an interrupted chunk wrote past the recorded offset
+                f.seek(offset)
+                f.truncate()
+                try:
+                    while chunk:=request.stream.read(ingest_buffer_size):
+                        if received+len(chunk)>upload["size"]:
+                            f.truncate(offset)
+                            received=offset
+                            file_hash=None
+                            return make_json_error(413, "Chunk exceeds upload size")
+                        f.write(chunk)
+                        if file_hash: file_hash.update(chunk)
+                        received+=len(chunk)
+                # Whatever arrived before the connection dropped is kept, the retry starts from there
+                except ClientDisconnected: disconnected=True
+        finally:
+            if file_hash: upload_hashes.put(upload_id, (received, file_hash))
+            db.execute("UPDATE uploads SET received=?, writer=NULL WHERE id=? AND writer=?", (received, upload_id, writer))
+            db.commit()
+    if disconnected: return make_json_error(400, "Upload interrupted")
+    return jsonify({"success": True, "offset": received})
+
+@uploads_bp.route("/upload/<string:upload_id>/finalize", methods=["POST"])
+@logged_in()
+@sliding_window_rate_limiter(limit=60, window=60, user_limit=30)
+def finalize_upload(db:SQLite, id, upload_id):
+    with upload_lock(upload_id):
+        upload=get_upload(db, id, upload_id)
+        if not upload: return make_json_error(404, "Upload not found")
+        # Finalizing twice is fine, the first response may have been lost
+        if upload["file_id"]: return jsonify({"success": True, "upload": upload_info(upload)})
+        if upload["received"]!=upload["size"]: return offset_mismatch(upload, "Upload is incomplete")
+        writer=claim_upload(db, id, upload_id, "received=size")
+        if not writer:
+            upload=get_upload(db, id, upload_id)
+            if not upload: return make_json_error(404, "Upload not found")
+            if upload["file_id"]: return jsonify({"success": True, "upload": upload_info(upload)})
+            return offset_mismatch(upload, "Upload is being written")
+        path=upload_path(upload_id)
+        try:
+            cached=upload_hashes.pop(upload_id)
+            file_hash=cached[1].hexdigest() if cached and cached[0]==upload["size"] else db.calculate_file_hash(path)
+            file_info=store_file(path, file_hash, upload["size"], "attachment", db, upload["filename"], upload["mimetype"])
+            if os.path.exists(path): os.remove(path)
+            upload["file_id"]=file_info["id"]
+        finally:
+            db.execute("UPDATE uploads SET file_id=?, writer=NULL WHERE id=? AND writer=?", (upload["file_id"], upload_id, writer))
+            db.commit()
+    return jsonify({"success": True, "upload": upload_info(upload)})
+
+@uploads_bp.route("/upload/<string:upload_id>", methods=["DELETE"])
+@logged_in()
+@sliding_window_rate_limiter(limit=60, window=60, user_limit=30)
+def delete_upload(db:SQLite, id, upload_id):
+    with upload_lock(upload_id):
+        upload=get_upload(db, id, upload_id)
+        if not upload: return make_json_error(404, "Upload not found")
+        db.delete_data("uploads", {"id": upload_id})
+        upload_hashes.pop(upload_id)
+        if os.path.exists(upload_path(upload_id)): os.remove(upload_path(upload_id))
+    if upload["file_id"]: db.cleanup_unused_files()
+    return jsonify({"success": True})
+
+
+@uploads_bp.route("/files/known", methods=["POST"])
+@logged_in()
+@sliding_window_rate_limiter(limit=60, window=60, user_limit=30)
+def known_files(db:SQLite, id):
+    # Stored attachments matching a sha256 and size that the caller could already read, messages reference the returned ids with the hash in file_ids instead of uploading the bytes again
+    files=request.get_json(silent=True)
+    if not isinstance(files, list): return make_json_error(400, "Invalid payload format")
+    if len(files)>100: return make_json_error(400, "Too many files requested")
+    for file in files:
+        if not isinstance(file, dict) or not isinstance(file.get("hash"), str) or not sha256_regex.fullmatch(file["hash"]) or not isinstance(file.get("size"), int): return make_json_error(400, "Invalid file, hash and size are required")
+    if not files: return jsonify({"success": True, "files": []})
+    sizes={(file["hash"], file["size"]) for file in files}
+    known=reusable_files(db, id, "hash", [file["hash"] for file in files])
+    return jsonify({"success": True, "files": [file for file in known if (file["hash"], file["size"]) in sizes]})
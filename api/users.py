@@ -1,8 +1,8 @@
 from flask import Blueprint, request, jsonify
 from .utils import (
-    logged_in, sliding_window_rate_limiter, make_json_error, handle_pfp,
-    perm, has_permission, timestamp, hash_token, public_key_open, get_challenge,
-    challenges_lock, challenges
+    logged_in, sliding_window_rate_limiter, make_json_error, handle_pfp, staged_uploads,
+    perm, has_permission, timestamp, hash_token, user_public_key, get_challenge,
+    challenges, session_cache, public_key_cache, message_cache, list_versions, not_modified
 )
 from .stream import member_info_changed, member_leave, channel_deleted
 from db import SQLite
@@ -21,12 +21,14 @@ def me(db:SQLite, id, session_token):
         session_user_data=db.execute_raw_sql("SELECT u.public_key, s.logged_in_at FROM users u JOIN session s ON u.id=s.user WHERE s.token_hash=?", (hashed_token,))
         if not session_user_data: return make_json_error(401, "Unauthorized")
         session_user_data=session_user_data[0]
-        public_key, error_resp=public_key_open(session_user_data["public_key"])
+        public_key, error_resp=user_public_key(id, session_user_data["public_key"])
         if error_resp: return error_resp
         logged_in_at=session_user_data["logged_in_at"]
-        challenge_id, challenge_hash, challenge_enc=get_challenge(public_key)
+        challenge_id, challenge_digest, challenge_enc=get_challenge(public_key)
         if not db.delete_data("session", {"token_hash": hashed_token}): return make_json_error(401, "Unauthorized")
-        with challenges_lock: challenges[challenge_id]={"id": id, "hashed": challenge_hash, "expire": timestamp()+60, "logged_in_at": logged_in_at}
+        session_cache.invalidate(token_hash=hashed_token)
+        list_versions.bump(("sessions", id))
+        challenges.put(challenge_id, {"id": id, "digest": challenge_digest, "logged_in_at": logged_in_at}, 60)
         return jsonify({"id": challenge_id, "challenge": challenge_enc, "success": False}), 419
 
     user_data=db.select_data("users", ["id", "username", "pfp", "display_name AS display"], {"id": id})[0]
@@ -35,14 +37,17 @@ def me(db:SQLite, id, session_token):
 @users_bp.route("/me/logout", methods=["DELETE"])
 @sliding_window_rate_limiter(limit=10, window=60, user_limit=5)
 @logged_in()
-def logout(db:SQLite, session_id):
+def logout(db:SQLite, id, session_id):
     deleted_rows=db.delete_data("session", {"id": session_id})
+    session_cache.invalidate(session_id=session_id)
+    list_versions.bump(("sessions", id))
     if deleted_rows==0: return make_json_error(404, "Session not found")
     return jsonify({"success": True})
 
 @users_bp.route("/me", methods=["PATCH"])
 @logged_in()
 @sliding_window_rate_limiter(limit=20, window=60, user_limit=10)
+@staged_uploads("pfp")
 def edit_me(db:SQLite, id):
     db.close()
     update_data={}
@@ -71,6 +76,9 @@ def edit_me(db:SQLite, id):
         db_cleanup=SQLite()
         try: db_cleanup.cleanup_unused_files()
         finally: db_cleanup.close()
+    # Cached messages carry the author's name and pfp
+    message_cache.invalidate()
+    list_versions.bump(("profiles",))
     member_info_changed(id, updated_user, db)
     return jsonify({"updated_user": updated_user, "errors": errors, "success": True})
 
@@ -110,6 +118,10 @@ def delete_account(db:SQLite, id):
         db.delete_data("channels", {"id": channel_id})
     pfp=db.select_data("users", ["pfp"], {"id": id})
     db.delete_data("users", {"id": id})
+    session_cache.invalidate(user_id=id)
+    public_key_cache.pop(id)
+    message_cache.invalidate()
+    list_versions.bump(("profiles",))
     if pfp and pfp[0]["pfp"]: db.cleanup_unused_files()
     db.cleanup_unused_files()
     db.cleanup_unused_keys()
@@ -119,6 +131,7 @@ def delete_account(db:SQLite, id):
 @sliding_window_rate_limiter(limit=50, window=60, user_limit=25)
 @logged_in()
 def sessions_get(db:SQLite, id, session_id):
+    if resp:=not_modified(session_id, ("sessions", id)): return resp
     sessions=db.select_data("session", ["id", "device", "browser", "logged_in_at"], {"user": id}, "seq DESC")
     for session in sessions: session["current"]=session["id"]==session_id
     return jsonify(sessions)
@@ -128,6 +141,8 @@ def sessions_get(db:SQLite, id, session_id):
 @logged_in()
 def sessions_delete(db:SQLite, id):
     deleted_rows=db.delete_data("session", {"user": id})
+    session_cache.invalidate(user_id=id)
+    list_versions.bump(("sessions", id))
     return jsonify({"success": True, "deleted_sessions": deleted_rows})
 
 @users_bp.route("/me/session/<string:session>", methods=["DELETE"])
@@ -135,6 +150,8 @@ def sessions_delete(db:SQLite, id):
 @logged_in()
 def session_delete(db:SQLite, id, session):
     deleted_rows=db.delete_data("session", {"id": session, "user": id})
+    session_cache.invalidate(session_id=session)
+    list_versions.bump(("sessions", id))
     if deleted_rows==0: return make_json_error(404, "Session not found")
     return jsonify({"success": True})
 
@@ -142,6 +159,7 @@ def session_delete(db:SQLite, id, session):
 @logged_in()
 @sliding_window_rate_limiter(limit=100, window=60, user_limit=30)
 def get_blocks(db:SQLite, id):
+    if resp:=not_modified(id, ("blocks", id), ("profiles",)): return resp
     blocks=db.execute_raw_sql("""
         SELECT u.username, u.display_name AS display, u.pfp, b.blocked_at
         FROM blocks b
@@ -167,6 +185,7 @@ def block_user(db:SQLite, id, username):
     if id==target_user_id: return make_json_error(400, "Cannot block yourself")
     if data["already_blocked"]: return make_json_error(409, "User is already blocked")
     db.insert_data("blocks", {"blocker_id": id, "blocked_id": target_user_id, "blocked_at": timestamp()})
+    list_versions.bump(("blocks", id))
     return jsonify({"success": True})
 
 @users_bp.route("/me/block/<string:username>", methods=["DELETE"])
@@ -184,4 +203,5 @@ def unblock_user(db:SQLite, id, username):
     target_user_id=data["target_user_id"]
     if not data["is_blocked"]: return make_json_error(404, "User is not blocked")
     db.delete_data("blocks", {"blocker_id": id, "blocked_id": target_user_id})
+    list_versions.bump(("blocks", id))
     return jsonify({"success": True})
\ No newline at end of file
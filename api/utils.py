@@ -1,18 +1,18 @@
-from flask import request, make_response, jsonify
-from db import SQLite
+from flask import request, make_response, jsonify, current_app, Request, g
+from db import SQLite, file_cleanup_hooks
 import base64
-from PIL import Image
-from cryptography.hazmat.primitives import serialization, hashes
-from cryptography.hazmat.primitives.asymmetric import padding
-import bcrypt
 import time
 import os
 import hashlib
+import hmac
 import re
-from functools import wraps
+from functools import wraps, cache
 import inspect
-from threading import Lock
-from utils import config, generate
+from threading import Lock, Event
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from utils import config, generate, storage_dir, stored_file_path, colored_log, RED
+from .state import rate_limiter, challenges
 import math
 
 os.makedirs(config["data_dir"]["pfps"], exist_ok=True)
@@ -30,68 +30,157 @@ def create_dm_id(user1_id, user2_id):
     sorted_ids=sorted([user1_id, user2_id])
     return f"{sorted_ids[0]}:{sorted_ids[1]}"
 
-def get_channel_last_message_seq(db: SQLite, channel_id: str) -> int:
-    result=db.execute_raw_sql("SELECT MAX(seq) as last_seq FROM messages WHERE channel_id=?", (channel_id,))
-    return result[0]["last_seq"] if result and result[0]["last_seq"] is not None else 0
-
-def get_file_size_chunked(file, max_size, chunk_size=8192):
-    """Get file size using chunked reading, stopping if max_size is exceeded"""
-    file.stream.seek(0)
-    total_size=0
-    while True:
-        chunk=file.stream.read(chunk_size)
-        if not chunk:
-            break
-        total_size+=len(chunk)
-        if total_size>max_size:
-            file.stream.seek(0)
-            return total_size
-    file.stream.seek(0)
-    return total_size
+class ChannelState:
+    """Last message seq and current key (seq, key_id, expires_at) of channels, read from the database on a miss and kept current by the writes that change them
+    Both only move forward by seq so a load racing a write can't overwrite the newer value, key expiry is the exception and drops loads in flight"""
+    def __init__(self, max_channels):
+        self.max_channels=max_channels
+        self.seqs=OrderedDict()
+        self.keys=OrderedDict()
+        self.lock=Lock()
+        self.key_generation=0
+
+    def _get(self, entries, channel_id):
+        with self.lock:
+            if channel_id not in entries: return None
+            entries.move_to_end(channel_id)
+            return entries[channel_id]
+
+    def _put(self, entries, channel_id, value, newer):
+        with self.lock:
+            current=entries.get(channel_id)
+            if current is not None and not newer(value, current): return current
+            if self.max_channels:
+                entries[channel_id]=value
+                entries.move_to_end(channel_id)
+                while len(entries)>self.max_channels: entries.popitem(last=False)
+            return value
+
+    def last_message_seq(self, db: SQLite, channel_id):
+        seq=self._get(self.seqs, channel_id)
+        if seq is not None: return seq
+        result=db.execute_raw_sql("SELECT MAX(seq) as last_seq FROM messages WHERE channel_id=?", (channel_id,))
+        return self.message_inserted(channel_id, result[0]["last_seq"] if result and result[0]["last_seq"] is not None else 0)
+
+    def message_inserted(self, channel_id, seq): return self._put(self.seqs, channel_id, seq, lambda new, old: new>old)
+
+    def current_key(self, db: SQLite, channel_id):
+        """(key_id, expires_at) of the channel's latest key, or None if it never had one"""
+        key=self._get(self.keys, channel_id)
+        if key is None:
+            generation=self.key_generation
+            result=db.execute_raw_sql("SELECT seq, key_id, expires_at FROM channels_keys_info WHERE channel_id=? ORDER BY seq DESC LIMIT 1", (channel_id,))
+            key=(result[0]["seq"], result[0]["key_id"], result[0]["expires_at"]) if result else (0, None, 0)
+            with self.lock: stale=generation!=self.key_generation
+            if not stale: key=self.key_rotated(channel_id, *key)
+        return key[1:] if key[1] else None
+
+    def key_rotated(self, channel_id, seq, key_id, expires_at): return self._put(self.keys, channel_id, (seq, key_id, expires_at), lambda new, old: new[0]>old[0])
+
+    def keys_expired(self, channel_id):
+        with self.lock:
+            self.key_generation+=1
+            self.keys.pop(channel_id, None)
+
+# Only kept with in-memory state, worker processes would each miss the others' writes
+channel_state=ChannelState(config["cache"]["channel_state"] if config["server"]["state"]=="memory" else 0)
+
+def get_channel_last_message_seq(db: SQLite, channel_id: str) -> int: return channel_state.last_message_seq(db, channel_id)
+
+ingest_buffer_size=1<<20
+
+class StagedUpload:
+    """Writable file for an upload in the data dir, hashed and size checked as it's written so storing it is only a rename"""
+    def __init__(self, file_type, max_size):
+        self.max_size=max_size
+        self.path=os.path.join(storage_dir(file_type), f"temp_{generate()}")
+        self.file=open(self.path, "w+b")
+        self.hash=hashlib.sha256()
+        self.size=0
+
+    def write(self, data):
+        # Past the limit bytes are counted and dropped, so an oversized part never fills the disk
+        self.size+=len(data)
+        if self.size<=self.max_size:
+            self.hash.update(data)
+            self.file.write(data)
+        return len(data)
+
+    def __getattr__(self, name): return getattr(self.file, name)
+
+    def close(self):
+        self.file.close()
+        if os.path.exists(self.path): os.remove(self.path)
+
+def staged_uploads(file_type):
+    """Mark an endpoint so its multipart file parts are parsed straight into StagedUploads"""
+    def decorator(f):
+        f.staged_uploads=file_type
+        return f
+    return decorator
+
+class UploadRequest(Request):
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        file_type=getattr(current_app.view_functions.get(self.endpoint), "staged_uploads", None)
+        if not file_type: return super()._get_file_stream(total_content_length, content_type, filename, content_length)
+        return StagedUpload(file_type, config["max_file_size"]["attachments" if file_type=="attachment" else "pfps"])
+
+def ingest_file(stream, file_type, max_size, db: SQLite, filename=None, mimetype=None):
+    """Store an upload, reusing the stored file with the same hash if there is one.
+    Streams that aren't StagedUploads already are hashed, size checked and written in a single pass.
+    Returns the files row, or None if the upload is bigger than max_size"""
+    staged=stream if isinstance(stream, StagedUpload) else StagedUpload(file_type, max_size)
+    try:
+        if staged is not stream:
+            buffer=bytearray(ingest_buffer_size)
+            view=memoryview(buffer)
+            while (read:=stream.readinto(buffer)) and staged.size<=max_size: staged.write(view[:read])
+        if staged.size>max_size or staged.size>staged.max_size: return None
+        staged.file.close()
+        return store_file(staged.path, staged.hash.hexdigest(), staged.size, file_type, db, filename, mimetype)
+    finally:
+        if staged is not stream: staged.close()
+
+def store_file(path, file_hash, size, file_type, db: SQLite, filename=None, mimetype=None):
+    """Move a fully written and hashed file at path into storage, or leave it for the caller to remove if the same file is already stored"""
+    existing_file=db.select_data("files", ["id", "filename", "size", "mimetype"], {"hash": file_hash, "file_type": file_type})
+    if existing_file: return existing_file[0]
+    file_id=generate()
+    stored_path=stored_file_path(file_type, file_id)
+    os.makedirs(os.path.dirname(stored_path), exist_ok=True)
+    os.rename(path, stored_path)
+    db.insert_data("files", {"id": file_id, "filename": filename, "hash": file_hash, "size": size, "mimetype": mimetype, "file_type": file_type})
+    return {"id": file_id, "filename": filename, "size": size, "mimetype": mimetype}
+
+def reusable_files(db: SQLite, user_id, column, values):
+    """Stored attachments user_id may attach without uploading, the ones they uploaded unencrypted or that are only attached unencrypted in channels they are in"""
+    return db.execute_raw_sql(f"""
+        SELECT f.id, f.hash, f.size, f.mimetype FROM files f
+        WHERE f.file_type='attachment' AND f.{column} IN ({", ".join("?"*len(values))})
+        AND (EXISTS (SELECT 1 FROM uploads u WHERE u.file_id=f.id AND u.user_id=? AND u.encrypted=0)
+            OR (EXISTS (SELECT 1 FROM attachment_message am JOIN messages m ON m.id=am.message_id JOIN members mb ON mb.channel_id=m.channel_id WHERE am.file_id=f.id AND mb.user_id=?)
+                AND NOT EXISTS (SELECT 1 FROM attachment_message am WHERE am.file_id=f.id AND am.encrypted=1)))
+    """, [*values, user_id, user_id])
 
 def handle_pfp(error_as_text: bool=False, db: SQLite=None):
     if not request.files or "pfp" not in request.files: return None
     pfp_file=request.files["pfp"]
     if not pfp_file.filename: return None
-    if pfp_file.content_length and pfp_file.content_length>config["max_file_size"]["pfps"] and get_file_size_chunked(pfp_file, config["max_file_size"]["pfps"])>config["max_file_size"]["pfps"]: return make_json_error(413, "Profile picture exceed file size limit") if not error_as_text else "Profile picture exceed file size limit", True
+    if pfp_file.content_length and pfp_file.content_length>config["max_file_size"]["pfps"]: return make_json_error(413, "Profile picture exceed file size limit") if not error_as_text else "Profile picture exceed file size limit", True
     if pfp_file.mimetype!="image/webp": return make_json_error(400, "Profile picture must be WebP format") if not error_as_text else "Profile picture must be WebP format", True
     try:
+        from PIL import Image
         image=Image.open(pfp_file.stream)
         if image.format.lower()!="webp": return make_json_error(400, "Profile picture must be WebP format") if not error_as_text else "Profile picture must be WebP format", True
         if image.size[0]>256 or image.size[1]>256: return make_json_error(400, "Profile picture must be 256x256 or smaller") if not error_as_text else "Profile picture must be 256x256 or smaller", True
-
-        # Save to temp file first for hash calculation
-        temp_filename=f"temp_{generate()}.webp"
-        temp_filepath=os.path.join(config["data_dir"]["pfps"], temp_filename)
         pfp_file.stream.seek(0)
-        with open(temp_filepath, "wb") as f: f.write(pfp_file.stream.read())
-
-        # Calculate hash and check for duplicates
-        if db is None:
-            db=SQLite()
-            close_db=True
-        else:
-            close_db=False
-        try:
-            file_hash=db.calculate_file_hash(temp_filepath)
-            file_size=os.path.getsize(temp_filepath)
-
-            existing_file=db.select_data("files", ["id"], {"hash": file_hash, "file_type": "pfp"})
-
-            if existing_file:
-                os.remove(temp_filepath)
-                return existing_file[0]["id"]
-            else:
-                file_id=generate()
-                final_filename=f"{file_id}.webp"
-                final_filepath=os.path.join(config["data_dir"]["pfps"], final_filename)
-                os.rename(temp_filepath, final_filepath)
-
-                db.insert_data("files", {"id": file_id, "hash": file_hash, "size": file_size, "file_type": "pfp", "mimetype": "image/webp"})
-                return file_id
+        close_db=db is None
+        if close_db: db=SQLite()
+        try: file_data=ingest_file(pfp_file.stream, "pfp", config["max_file_size"]["pfps"], db, mimetype="image/webp")
         finally:
-            if close_db:
-                db.close()
+            if close_db: db.close()
+        if not file_data: return make_json_error(413, "Profile picture exceed file size limit") if not error_as_text else "Profile picture exceed file size limit", True
+        return file_data["id"]
     except Exception: return make_json_error(400, "Invalid image file") if not error_as_text else "Invalid image file", True
 
 def pass_db(f):
@@ -119,15 +208,11 @@ def logged_in(stream=False):
             token=auth_header_split[1]
             if scheme!="Bearer": return make_json_error(401, f"Bad authorization {"header" if not stream else "request argument"} scheme")
             kwargs_extra={}
-            get=[]
-            if pass_id: get.append("user")
-            if pass_session_id: get.append("id")
-            if get:
-                data=db.select_data("session", get, {"token_hash": hash_token(token)})
-                if not data: return make_json_error(401, "Unauthorized")
-                data=data[0]
-            if pass_id: kwargs_extra["id"]=data["user"]
-            if pass_session_id: kwargs_extra["session_id"]=data["id"]
+            if pass_id or pass_session_id:
+                session=session_cache.get(hash_token(token), db)
+                if not session: return make_json_error(401, "Unauthorized")
+            if pass_id: kwargs_extra["id"]=session[0]
+            if pass_session_id: kwargs_extra["session_id"]=session[1]
             if pass_session_token: kwargs_extra["session_token"]=token
             if do_pass_db: kwargs_extra["db"]=db
             else: db.close()
@@ -176,93 +261,364 @@ def has_permission(user_permissions, required_permission, channel_permissions):
     if (user_permissions&perm.owner or user_permissions&perm.admin) and not required_permission&perm.owner: return True
     return bool(user_permissions&required_permission)
 
-rsa_padding=padding.OAEP(mgf=padding.MGF1(algorithm=hashes.SHA256()), algorithm=hashes.SHA256(), label=b"parley")
+# cryptography, bcrypt and PIL are imported where they're used so they stay off the startup path
+@cache
+def rsa_padding():
+    from cryptography.hazmat.primitives import hashes
+    from cryptography.hazmat.primitives.asymmetric import padding
+    return padding.OAEP(mgf=padding.MGF1(algorithm=hashes.SHA256()), algorithm=hashes.SHA256(), label=b"parley")
 
 def public_key_open(public_key_base64=None):
+    from cryptography.hazmat.primitives import serialization
     try: return serialization.load_der_public_key(base64.b64decode(public_key_base64 if public_key_base64 else request.form["public"])), None
     except Exception as e: return None, make_json_error(400, f"Invalid public key: {e}")
 
-def rsa_encrypt(public_key, plaintext): return base64.b64encode(public_key.encrypt(plaintext[:100].encode(), rsa_padding)).decode()
+def user_public_key(user_id, public_key_base64):
+    """public_key_open for a stored user key, loaded keys are cached per user"""
+    cached=public_key_cache.get(user_id)
+    if cached and cached[0]==public_key_base64: return cached[1], None
+    public_key, error_resp=public_key_open(public_key_base64)
+    if public_key: public_key_cache.put(user_id, (public_key_base64, public_key))
+    return public_key, error_resp
+
+def rsa_encrypt(public_key, plaintext): return base64.b64encode(public_key.encrypt(plaintext[:100].encode(), rsa_padding())).decode()
 
 def rsa_verify_signature(public_key, signature_base64, data):
+    from cryptography.hazmat.primitives import hashes
+    from cryptography.hazmat.primitives.asymmetric import padding
     try:
         signature=base64.b64decode(signature_base64)
         public_key.verify(signature, data.encode(), padding.PSS(mgf=padding.MGF1(hashes.SHA256()), salt_length=padding.PSS.MAX_LENGTH), hashes.SHA256())
         return True
     except: return False
 
+# bcrypt releases the GIL, so threads run it on every core, the pool only caps how many cores a burst of logins can take from request threads
+crypto_executor=ThreadPoolExecutor(max_workers=config["server"]["crypto_workers"], thread_name_prefix="crypto")
+
+def hash_passkey(passkey):
+    import bcrypt
+    return crypto_executor.submit(bcrypt.hashpw, passkey.encode(), bcrypt.gensalt()).result().decode()
+
+def check_passkey(passkey, hashed_passkey):
+    import bcrypt
+    return crypto_executor.submit(bcrypt.checkpw, passkey.encode(), hashed_passkey.encode()).result()
+
+# Challenges are random and live for a minute, so a keyed SHA-256 is enough and bcrypt would only burn CPU
+def challenge_digest(challenge_id, challenge): return hmac.new(challenge_id.encode(), challenge.encode(), hashlib.sha256).hexdigest()
+
+def check_challenge(challenge_id, solve, digest): return hmac.compare_digest(challenge_digest(challenge_id, solve), digest)
+
 def get_challenge(public_key):
+    challenge_id=generate()
     challenge=generate()
-    return generate(), bcrypt.hashpw(challenge.encode(), bcrypt.gensalt()).decode(), rsa_encrypt(public_key, challenge)
+    return challenge_id, challenge_digest(challenge_id, challenge), rsa_encrypt(public_key, challenge)
 
 browser_regex=re.compile(r"([a-zA-Z]+)\/[0-9.]+(?: Mobile(?:\/[0-9a-zA-Z]+)?)?(?: Safari\/[0-9]+.[0-9]+)?$")
 device_regex=re.compile(r"^.*?\(([a-zA-Z0-9]+)")
 
 def regex_first_group_encrypted(match, public_key): return rsa_encrypt(public_key, match.group(1)[:50]) if match else None
 
-challenges={}
-challenges_lock=Lock()
-
-all_sliding_window_ratelimits=[]
+class LRUCache:
+    """Thread safe bounded LRU cache, optionally also bounded by the total sizeof() of its values"""
+    def __init__(self, max_entries, max_bytes=None, sizeof=len):
+        self.max_entries=max_entries
+        self.max_bytes=max_bytes
+        self.sizeof=sizeof
+        self.size=0
+        self.entries=OrderedDict()
+        self.lock=Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            if key not in self.entries: return default
+            self.entries.move_to_end(key)
+            return self.entries[key]
+
+    def put(self, key, value):
+        if self.max_bytes is None:
+            with self.lock:
+                self.entries[key]=value
+                self.entries.move_to_end(key)
+                while len(self.entries)>self.max_entries: self.entries.popitem(last=False)
+            return
+        size=self.sizeof(value)
+        if size>self.max_bytes: return
+        with self.lock:
+            if key in self.entries: self.size-=self.sizeof(self.entries.pop(key))
+            self.entries[key]=value
+            self.size+=size
+            while len(self.entries)>self.max_entries or self.size>self.max_bytes: self.size-=self.sizeof(self.entries.popitem(last=False)[1])
+
+    def pop(self, key):
+        with self.lock:
+            value=self.entries.pop(key, None)
+            if value is not None and self.max_bytes is not None: self.size-=self.sizeof(value)
+            return value
+
+public_key_cache=LRUCache(config["cache"]["public_keys"])
+# Pfp id -> (bytes, hash, mimetype), stored files never change so entries only go when the file is removed
+pfp_cache=LRUCache(config["cache"]["pfps"], config["cache"]["pfp_bytes"], lambda pfp: len(pfp[0]))
+
+def forget_removed_pfps(file_ids):
+    for file_id in file_ids: pfp_cache.pop(file_id)
+
+file_cleanup_hooks.append(forget_removed_pfps)
+
+class SessionCache:
+    """Bounded LRU of token_hash -> (user_id, session_id) with a TTL, callers must invalidate when they delete sessions"""
+    def __init__(self, max_entries, ttl):
+        self.max_entries=max_entries
+        self.ttl=ttl
+        self.entries=OrderedDict()
+        self.lock=Lock()
+        self.generation=0
+
+    def get(self, token_hash, db=None):
+        now=time.monotonic()
+        with self.lock:
+            entry=self.entries.get(token_hash)
+            if entry and entry[2]>now:
+                self.entries.move_to_end(token_hash)
+                return entry[0], entry[1]
+            generation=self.generation
+        own_db=db is None
+        if own_db: db=SQLite()
+        try: data=db.select_data("session", ["user", "id"], {"token_hash": token_hash})
+        finally:
+            if own_db: db.close()
+        if not data: return None
+        with self.lock:
+            # Skip caching if a session was invalidated while we were querying, the row we read may be gone
+            if generation==self.generation and self.max_entries:
+                self.entries[token_hash]=(data[0]["user"], data[0]["id"], now+self.ttl)
+                self.entries.move_to_end(token_hash)
+                while len(self.entries)>self.max_entries: self.entries.popitem(last=False)
+        return data[0]["user"], data[0]["id"]
+
+    def invalidate(self, token_hash=None, session_id=None, user_id=None):
+        with self.lock:
+            self.generation+=1
+            if token_hash: self.entries.pop(token_hash, None)
+            if session_id or user_id:
+                for key in [k for k, v in self.entries.items() if v[1]==session_id or v[0]==user_id]: del self.entries[key]
+
+# Other workers can't see a logout or rotation, so sessions are only cached with a single process
+session_cache=SessionCache(config["cache"]["sessions"] if config["server"]["state"]=="memory" else 0, config["cache"]["session_ttl"])
+
+def hide_message_author(message): return {**message, "user": None, "signature": None, "signed_timestamp": None, "verified": None}
+
+class MessageWindowCache:
+    """Newest messages of recently read channels as (seq, message, message with the author hidden), newest first
+    The send, edit and delete paths keep windows current, loads that raced with one of them aren't stored"""
+    def __init__(self, max_channels, window, ttl):
+        self.max_channels=max_channels
+        self.window=window
+        self.ttl=ttl
+        # channel_id -> [expires_at, messages, complete], messages lists are replaced rather than mutated so readers need no lock
+        self.entries=OrderedDict()
+        self.loading={}
+        self.lock=Lock()
+
+    def get(self, channel_id):
+        with self.lock:
+            entry=self.entries.get(channel_id)
+            if not entry: return None
+            if entry[0]<=time.monotonic():
+                del self.entries[channel_id]
+                return None
+            self.entries.move_to_end(channel_id)
+            return entry[1], entry[2]
+
+    def load(self, channel_id, fetch):
+        """fetch() returns up to window+1 newest (seq, message) rows"""
+        token=object()
+        with self.lock: self.loading.setdefault(channel_id, {})[token]=False
+        try: rows=fetch()
+        finally:
+            with self.lock:
+                loads=self.loading[channel_id]
+                changed=loads.pop(token)
+                if not loads: del self.loading[channel_id]
+        messages=[(seq, message, hide_message_author(message)) for seq, message in rows[:self.window]]
+        complete=len(rows)<=self.window
+        if not changed and self.max_channels:
+            with self.lock:
+                self.entries[channel_id]=[time.monotonic()+self.ttl, messages, complete]
+                self.entries.move_to_end(channel_id)
+                while len(self.entries)>self.max_channels: self.entries.popitem(last=False)
+        return messages, complete
+
+    def _changed(self, channel_id):
+        loads=self.loading.get(channel_id)
+        if loads:
+            for token in loads: loads[token]=True
+        return self.entries.get(channel_id)
+
+    def changed(self, channel_id):
+        """Drop loads in flight for the channel, returns whether it has a window worth updating"""
+        with self.lock: return self._changed(channel_id) is not None
+
+    def add(self, channel_id, rows):
+        with self.lock:
+            entry=self._changed(channel_id)
+            if not entry: return
+            ids={message["id"] for _, message, _ in entry[1]}
+            messages=sorted(entry[1]+[(seq, message, hide_message_author(message)) for seq, message in rows if message["id"] not in ids], key=lambda m: m[0], reverse=True)
+            if len(messages)>self.window: entry[2]=False
+            entry[1]=messages[:self.window]
+
+    def update(self, channel_id, message):
+        with self.lock:
+            entry=self._changed(channel_id)
+            if entry: entry[1]=[(seq, message, hide_message_author(message)) if cached["id"]==message["id"] else (seq, cached, hidden) for seq, cached, hidden in entry[1]]
+
+    def remove(self, channel_id, message_id):
+        with self.lock:
+            entry=self._changed(channel_id)
+            if entry: entry[1]=[m for m in entry[1] if m[1]["id"]!=message_id]
+
+    def set_verified(self, results):
+        """results maps message_id -> (signature, verified)"""
+        with self.lock:
+            for channel_id in list(self.loading): self._changed(channel_id)
+            for entry in self.entries.values():
+                if any(m[1]["id"] in results for m in entry[1]):
+                    entry[1]=[(seq, {**message, "verified": results[message["id"]][1]}, hidden) if message["id"] in results and message["signature"]==results[message["id"]][0] else (seq, message, hidden) for seq, message, hidden in entry[1]]
+
+    def invalidate(self, channel_id=None):
+        with self.lock:
+            for loading_id in [channel_id] if channel_id else list(self.loading): self._changed(loading_id)
+            if channel_id: self.entries.pop(channel_id, None)
+            else: self.entries.clear()
+
+# Only kept with in-memory state, worker processes would each hold windows the others' writes never reach
+message_cache=MessageWindowCache(config["cache"]["channel_messages"] if config["server"]["state"]=="memory" else 0, config["cache"]["message_window"], config["cache"]["message_window_ttl"])
+
+class ListVersions:
+    """Change counters of list endpoints, bumped after the writes that change a list so a client polling an unchanged one gets a 304 before any query runs
+    Counters restart with the process, the boot nonce keeps tags handed out before a restart from matching them again"""
+    def __init__(self, enabled, ttl):
+        self.enabled=enabled
+        self.ttl=ttl
+        self.nonce=generate()
+        self.counters={}
+        self.lock=Lock()
+
+    def bump(self, *keys):
+        if not self.enabled: return
+        with self.lock:
+            for key in keys: self.counters[key]=self.counters.get(key, 0)+1
+
+    def etag(self, scope, *keys):
+        """Tag of the list scope (user or session) sees at this path, or None when versions aren't tracked"""
+        if not self.enabled: return None
+        with self.lock: counts=[self.counters.get(key, 0) for key in keys]
+        # The ttl bucket bounds how long changes made outside the server (cli) stay hidden
+        return hashlib.blake2b(repr((self.nonce, int(time.time()//self.ttl), scope, request.full_path, keys, counts)).encode(), digest_size=16).hexdigest()
+
+# Only kept with in-memory state, worker processes would each miss the others' writes
+list_versions=ListVersions(config["server"]["state"]=="memory", config["cache"]["list_version_ttl"])
+
+def not_modified(scope, *keys):
+    """304 response if the client already has this list, otherwise None and the tag is set on the response by set_list_etag"""
+    etag=list_versions.etag(scope, *keys)
+    if not etag: return None
+    if request.if_none_match.contains_weak(etag):
+        resp=make_response("", 304)
+        resp.set_etag(etag)
+        resp.headers["Cache-Control"]="private, no-cache"
+        return resp
+    g.list_etag=etag
+
+def set_list_etag(resp):
+    if resp.status_code==200 and g.get("list_etag"):
+        resp.set_etag(g.list_etag)
+        resp.headers["Cache-Control"]="private, no-cache"
+    return resp
+
+class ReadCursors:
+    """Latest read message of each user's channels waiting to be written to message_reads, so acks on every focus change only cost a dict write.
+    Flushed in one transaction every reads.flush_interval or once reads.max_pending are waiting, before a user's channel list is read and on shutdown"""
+    def __init__(self, max_pending):
+        self.max_pending=max_pending
+        self.pending={}
+        self.size=0
+        self.lock=Lock()
+        self.full=Event()
+
+    def mark(self, user_id, channel_id, message_id, read_at):
+        with self.lock:
+            cursors=self.pending.setdefault(user_id, {})
+            if channel_id not in cursors: self.size+=1
+            cursors[channel_id]=(message_id, read_at)
+            full=self.size>=self.max_pending
+        list_versions.bump(("channels", user_id))
+        # Written by read_cursor_flusher, a failing write mustn't fail the send or ack that marked it
+        if full: self.full.set()
+
+    def flush(self, user_id=None):
+        with self.lock:
+            if user_id is None: batch, self.pending=self.pending, {}
+            else: batch={user_id: self.pending.pop(user_id)} if user_id in self.pending else {}
+            self.size-=sum(len(cursors) for cursors in batch.values())
+        if not batch: return
+        # Cursors whose message or membership went away in the meantime are skipped, and a slower flush never moves a cursor back
+        try:
+            with SQLite() as db: db.execute_many("""
+                INSERT INTO message_reads (user_id, channel_id, last_message_id, read_at)
+                SELECT ?, channel_id, id, ? FROM messages WHERE id=? AND channel_id=? AND EXISTS (SELECT 1 FROM members WHERE user_id=? AND channel_id=messages.channel_id)
+                ON CONFLICT(user_id, channel_id) DO UPDATE SET last_message_id=excluded.last_message_id, read_at=excluded.read_at WHERE excluded.read_at>=message_reads.read_at
+            """, [(user_id, read_at, message_id, channel_id, user_id) for user_id, cursors in batch.items() for channel_id, (message_id, read_at) in cursors.items()])
+        except Exception:
+            with self.lock:
+                for user_id, cursors in batch.items():
+                    for channel_id, cursor in cursors.items():
+                        if channel_id not in self.pending.setdefault(user_id, {}):
+                            self.pending[user_id][channel_id]=cursor
+                            self.size+=1
+            raise
+
+read_cursors=ReadCursors(config["reads"]["max_pending"])
+
+def read_cursor_flusher():
+    from utils import stopping
+    while not stopping.is_set():
+        read_cursors.full.wait(config["reads"]["flush_interval"])
+        read_cursors.full.clear()
+        try: read_cursors.flush()
+        except Exception as e: colored_log(RED, "ERROR", f"Read cursor flush failed: {e}")
 
 def cleaner():
     from utils import stopping
     while not stopping.is_set():
-        now=timestamp()
-        with challenges_lock:
-            for cid in list(challenges):
-                if challenges[cid]["expire"]<now: del challenges[cid]
-        for lock, sliding_window_ratelimits in all_sliding_window_ratelimits:
-            with lock:
-                for ip in list(sliding_window_ratelimits):
-                    while sliding_window_ratelimits[ip] and sliding_window_ratelimits[ip][0]<timestamp():
-                        del sliding_window_ratelimits[ip][0]
-                    if not sliding_window_ratelimits[ip]: del sliding_window_ratelimits[ip]
+        challenges.cleanup()
+        rate_limiter.cleanup()
+        db=SQLite()
+        try: db.cleanup_expired_uploads()
+        except Exception as e: colored_log(RED, "ERROR", f"Upload cleanup failed: {e}")
+        try: db.cleanup_channel_changes(config["sync"]["retention"])
+        except Exception as e: colored_log(RED, "ERROR", f"Change log cleanup failed: {e}")
+        finally: db.close()
         stopping.wait(30)
 
 def sliding_window_rate_limiter(limit=10, window=3600, user_limit=None):
-    ip_ratelimits={}
-    user_ratelimits={}
-    lock=Lock()
-    all_sliding_window_ratelimits.append((lock, ip_ratelimits))
-    all_sliding_window_ratelimits.append((lock, user_ratelimits))
     def decorator(f):
+        # Keyed by endpoint name rather than anything random so every worker process agrees on it
+        limiter_id=f"{f.__module__}.{f.__name__}"
         @wraps(f)
         def wrapper(*args, **kwargs):
-            with lock:
-                ip=request.remote_addr
-                if ip not in ip_ratelimits: ip_ratelimits[ip]=[]
-                while ip_ratelimits[ip] and ip_ratelimits[ip][0]<timestamp():
-                    del ip_ratelimits[ip][0]
-                if len(ip_ratelimits[ip])>=limit: 
-                    return jsonify({"success": False, "ratelimit": True, "type": "ip"}), 429, {"X-RateLimit-Limit": str(limit), "X-RateLimit-Remaining": "0", "X-RateLimit-Reset": str(ip_ratelimits[ip][0])}
-                user_id=None
-                if "Authorization" in request.headers:
-                    auth_header_split=request.headers["Authorization"].split(" ")
-                    if len(auth_header_split)>=2 and auth_header_split[0]=="Bearer" and len(auth_header_split[1])==20:
-                        db=SQLite()
-                        user_data=db.select_data("session", ["user"], {"token_hash": hash_token(auth_header_split[1])})
-                        if user_data: user_id=user_data[0]["user"]
-                        db.close()
-                if user_id and user_limit is not None:
-                    if user_id not in user_ratelimits: user_ratelimits[user_id]=[]
-                    while user_ratelimits[user_id] and user_ratelimits[user_id][0]<timestamp():
-                        del user_ratelimits[user_id][0]
-                    if len(user_ratelimits[user_id])>=user_limit:
-                        return jsonify({"success": False, "ratelimit": True, "type": "user"}), 429, {"X-RateLimit-Limit": str(user_limit), "X-RateLimit-Remaining": "0", "X-RateLimit-Reset": str(user_ratelimits[user_id][0])}
-                ip_ratelimits[ip].append(timestamp()+window)
-                if user_id and user_limit is not None: user_ratelimits[user_id].append(timestamp()+window)
-                ip_ratelimits_length=len(ip_ratelimits[ip])
-                ip_ratelimit_reset=ip_ratelimits[ip][0]
-                user_ratelimits_length=len(user_ratelimits[user_id]) if user_id and user_limit is not None else None
-                user_ratelimit_reset=user_ratelimits[user_id][0] if user_id and user_limit is not None and user_ratelimits[user_id] else None
-                limits=[{"limit": limit, "remaining": limit-ip_ratelimits_length, "reset": ip_ratelimit_reset}]
-                if user_id and user_limit is not None: limits.append({"limit": user_limit, "remaining": user_limit-user_ratelimits_length, "reset": user_ratelimit_reset})
-                lowest_limit=min(limits, key=lambda x: x["remaining"])
+            keys=[("ip", f"{limiter_id}:ip:{request.remote_addr}", limit, window)]
+            if user_limit is not None and "Authorization" in request.headers:
+                auth_header_split=request.headers["Authorization"].split(" ")
+                if len(auth_header_split)>=2 and auth_header_split[0]=="Bearer" and len(auth_header_split[1])==50:
+                    session=session_cache.get(hash_token(auth_header_split[1]))
+                    if session: keys.append(("user", f"{limiter_id}:user:{session[0]}", user_limit, window))
+            allowed, kind, key_limit, remaining, reset=rate_limiter.hit(keys)
+            if not allowed: return jsonify({"success": False, "ratelimit": True, "type": kind}), 429, {"X-RateLimit-Limit": str(key_limit), "X-RateLimit-Remaining": "0", "X-RateLimit-Reset": str(reset)}
             resp=make_response(f(*args, **kwargs))
-            resp.headers["X-RateLimit-Limit"]=str(lowest_limit["limit"])
-            resp.headers["X-RateLimit-Remaining"]=str(lowest_limit["remaining"])
-            if lowest_limit["reset"]: resp.headers["X-RateLimit-Reset"]=str(lowest_limit["reset"])
+            resp.headers["X-RateLimit-Limit"]=str(key_limit)
+            resp.headers["X-RateLimit-Remaining"]=str(remaining)
+            resp.headers["X-RateLimit-Reset"]=str(reset)
             return resp
         return wrapper
     return decorator
@@ -284,6 +640,50 @@ def get_pagination_params():
     offset=(page-1)*page_size
     return {"page": page, "page_size": page_size, "offset": offset}
 
+@cache
+def compressors():
+    """Content encodings responses can be sent with, most preferred first, zstd and brotli only when their modules are installed"""
+    import gzip
+    level=config["compression"]["level"]
+    encoders={}
+    try:
+        from compression import zstd
+        encoders["zstd"]=lambda data: zstd.compress(data, 3)
+    except ImportError:
+        try:
+            import zstandard
+            encoders["zstd"]=lambda data: zstandard.ZstdCompressor(level=3).compress(data)
+        except ImportError: pass
+    try:
+        import brotli
+        encoders["br"]=lambda data: brotli.compress(data, quality=4)
+    except ImportError: pass
+    encoders["gzip"]=lambda data: gzip.compress(data, level, mtime=0)
+    return encoders
+
+# (encoding, body digest) -> compressed body, for responses built from in-memory caches that many clients fetch unchanged
+compressed_cache=LRUCache(10000, config["compression"]["cache_bytes"])
+
+def compress_response(resp):
+    if not config["compression"]["enabled"] or resp.direct_passthrough or resp.is_streamed or resp.mimetype!="application/json" or "Content-Encoding" in resp.headers: return resp
+    resp.vary.add("Accept-Encoding")
+    body=resp.get_data()
+    if len(body)<config["compression"]["min_size"]: return resp
+    # Highest quality the client accepts, ties go to the order of compressors()
+    encoding=max(compressors(), key=lambda name: request.accept_encodings.quality(name), default=None)
+    if not encoding or not request.accept_encodings.quality(encoding): return resp
+    key=(encoding, hashlib.blake2b(body, digest_size=16).digest()) if g.get("cache_compressed") else None
+    data=compressed_cache.get(key) if key else None
+    if data is None:
+        data=compressors()[encoding](body)
+        if key: compressed_cache.put(key, data)
+    resp.set_data(data)
+    resp.headers["Content-Encoding"]=encoding
+    # The same tag now names several encodings of the body
+    etag, weak=resp.get_etag()
+    if etag and not weak: resp.set_etag(etag, weak=True)
+    return resp
+
 def process_cors_headers(resp):
     resp.headers["Access-Control-Allow-Headers"]="Accept, Accept-Encoding, Accept-Language, Authorization, Cache-Control, Connection, Content-Type, Host, Origin, Range, Referer, User-Agent"
     resp.headers["Access-Control-Allow-Methods"]="GET, HEAD, POST, PUT, PATCH, DELETE, OPTIONS"
@@ -1,7 +1,7 @@
 from flask import Blueprint, request, jsonify
 import json
 import re
-from .utils import make_json_error, logged_in, sliding_window_rate_limiter, timestamp, perm, has_permission
+from .utils import make_json_error, logged_in, sliding_window_rate_limiter, timestamp, perm, has_permission, channel_state
 from .stream import message_sent
 from utils import generate, config
 from db import SQLite
@@ -158,9 +158,9 @@ def webhook_action(channel_id, webhook_id, service=None):
         message_id=generate()
         webhook_name=payload["name"] or webhook_data["name"]
         webhook_pfp=payload["pfp"] or webhook_data["pfp"]
-        db.insert_data("messages", {"id": message_id, "channel_id": channel_id, "user_id": "0", "content": payload["content"], "key": None, "iv": None, "timestamp": sent_at, "replied_to": None, "signature": None, "signed_timestamp": None, "nonce": None, "webhook_id": webhook_id, "webhook_name": webhook_name, "webhook_pfp": webhook_pfp})
+        channel_state.message_inserted(channel_id, db.insert_data("messages", {"id": message_id, "channel_id": channel_id, "user_id": "0", "content": payload["content"], "key": None, "iv": None, "timestamp": sent_at, "replied_to": None, "signature": None, "signed_timestamp": None, "nonce": None, "webhook_id": webhook_id, "webhook_name": webhook_name, "webhook_pfp": webhook_pfp}))
         db.update_data("webhooks", {"last_used_at": sent_at}, {"id": webhook_id})
-        message_data={"id": message_id, "content": payload["content"], "key": None, "iv": None, "timestamp": sent_at, "edited_at": None, "replied_to": None, "user": {"username": None, "display": webhook_name, "pfp": webhook_pfp}, "attachments": [], "signature": None, "signed_timestamp": None, "nonce": None, "webhook_id": webhook_id}
+        message_data={"id": message_id, "content": payload["content"], "key": None, "iv": None, "timestamp": sent_at, "edited_at": None, "replied_to": None, "user": {"username": None, "display": webhook_name, "pfp": webhook_pfp}, "attachments": [], "signature": None, "signed_timestamp": None, "verified": None, "nonce": None, "webhook_id": webhook_id}
         message_sent(channel_id, message_data, "0", db)
         return jsonify({"message_id": message_id, "success": True}), 201
     finally:
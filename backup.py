@@ -0,0 +1,89 @@
+import os
+import shutil
+import sqlite3
+import time
+from datetime import datetime
+from utils import config, stopping, colored_log, BLUE, RED
+
+backup_name_format="%Y%m%d-%H%M%S"
+
+def backup_database(dest_path, progress=None):
+    """Copy the live database with the online backup API in small steps"""
+    src=sqlite3.connect(config["data_dir"]["database"])
+    dst=sqlite3.connect(dest_path)
+    def step(status, remaining, total):
+        if progress: progress(status, remaining, total)
+        if remaining: time.sleep(config["backups"]["step_sleep"])
+    try:
+        # Pin a WAL read snapshot, otherwise every concurrent write restarts the backup from the first page
+        src.execute("BEGIN")
+        src.execute("SELECT COUNT(*) FROM sqlite_master").fetchone()
+        with dst: src.backup(dst, pages=config["backups"]["pages_per_step"], progress=step)
+        src.rollback()
+    finally:
+        dst.close()
+        src.close()
+
+def snapshot_directory(src_dir, dest_dir):
+    """Hard link stored files into dest_dir keeping their fan-out directories, they are never modified in place"""
+    os.makedirs(dest_dir, exist_ok=True)
+    count=0
+    if not os.path.isdir(src_dir): return count
+    for entry in os.scandir(src_dir):
+        if entry.is_dir():
+            count+=snapshot_directory(entry.path, os.path.join(dest_dir, entry.name))
+            continue
+        if not entry.is_file() or entry.name.startswith("temp_"): continue
+        dest=os.path.join(dest_dir, entry.name)
+        try: os.link(entry.path, dest)
+        except FileNotFoundError: continue
+        except OSError: shutil.copy2(entry.path, dest)
+        count+=1
+    return count
+
+def list_backups():
+    backups_dir=config["data_dir"]["backups"]
+    if not os.path.isdir(backups_dir): return []
+    names=[]
+    for name in os.listdir(backups_dir):
+        try: datetime.strptime(name, backup_name_format)
+        except ValueError: continue
+        names.append(name)
+    return sorted(names)
+
+def prune_backups(keep):
+    backups=list_backups()
+    for name in backups[:max(len(backups)-keep, 0)]:
+        shutil.rmtree(os.path.join(config["data_dir"]["backups"], name), ignore_errors=True)
+
+def create_backup(progress=None):
+    """Create a timestamped backup of the database, pfps and attachments"""
+    backups_dir=config["data_dir"]["backups"]
+    os.makedirs(backups_dir, exist_ok=True)
+    name=datetime.now().strftime(backup_name_format)
+    temp_path=os.path.join(backups_dir, f"temp_{name}")
+    final_path=os.path.join(backups_dir, name)
+    shutil.rmtree(temp_path, ignore_errors=True)
+    os.makedirs(temp_path)
+    try:
+        # Database first, every file it references was written before its row so the links below cover it
+        backup_database(os.path.join(temp_path, os.path.basename(config["data_dir"]["database"])), progress)
+        snapshot_directory(config["data_dir"]["pfps"], os.path.join(temp_path, "pfps"))
+        snapshot_directory(config["data_dir"]["attachments"], os.path.join(temp_path, "attachments"))
+        os.rename(temp_path, final_path)
+    except Exception:
+        shutil.rmtree(temp_path, ignore_errors=True)
+        raise
+    prune_backups(config["backups"]["keep"])
+    return final_path
+
+def backup_scheduler():
+    interval=config["backups"]["interval"]
+    backups=list_backups()
+    last=time.mktime(datetime.strptime(backups[-1], backup_name_format).timetuple()) if backups else 0
+    stopping.wait(max(last+interval-time.time(), 60))
+    while not stopping.is_set():
+        started=time.time()
+        try: colored_log(BLUE, "INFO", f"Backup written to {create_backup()} in {time.time()-started:.1f}s")
+        except Exception as e: colored_log(RED, "ERROR", f"Backup failed: {e}")
+        stopping.wait(interval)
@@ -1,17 +1,59 @@
 #!/usr/bin/env python
 import sys
+import os
+import json
+import gzip
+import time
+import sqlite3
+import logging
 import argparse
 from datetime import datetime
 from rich.console import Console
+from rich.progress import Progress, BarColumn, TextColumn, TimeElapsedColumn, MofNCompleteColumn, DownloadColumn
 from rich.table import Table
 from rich.prompt import Confirm
 from rich.panel import Panel
 from rich import box
 from rich.text import Text
 from db import SQLite
+from utils import version, db_version, storage_dir, stored_file_path
+from backup import create_backup, list_backups
 
 console=Console()
 
+EXPORT_FORMAT=1
+EXPORT_USERS="""
+    SELECT user_id FROM members WHERE channel_id=?
+    UNION SELECT user_id FROM messages WHERE channel_id=?
+    UNION SELECT user_id FROM bans WHERE channel_id=?
+    UNION SELECT banned_by FROM bans WHERE channel_id=?
+    UNION SELECT created_by FROM webhooks WHERE channel_id=?
+    UNION SELECT cki.by FROM channels_keys_info cki WHERE cki.channel_id=?
+    UNION SELECT user_id FROM channels_keys WHERE channel_id=?
+    UNION SELECT user_id FROM message_reads WHERE channel_id=?
+"""
+# Parents come before children so foreign keys resolve while importing, the second value filters the table down to a single channel
+EXPORT_TABLES=[
+    ("files", f"""id IN (SELECT pfp FROM channels WHERE id=?)
+        OR id IN (SELECT pfp FROM users WHERE id IN ({EXPORT_USERS}))
+        OR id IN (SELECT am.file_id FROM attachment_message am JOIN messages msg ON msg.id=am.message_id WHERE msg.channel_id=?)"""),
+    ("users", f"id IN ({EXPORT_USERS})"),
+    ("channels", "id=?"),
+    ("members", "channel_id=?"),
+    ("bans", "channel_id=?"),
+    ("blocks", None),
+    ("webhooks", "channel_id=?"),
+    ("channels_keys_info", "channel_id=?"),
+    ("channels_keys", "channel_id=?"),
+    ("messages", "channel_id=?"),
+    ("attachment_message", "message_id IN (SELECT id FROM messages WHERE channel_id=?)"),
+    ("message_pins", "id IN (SELECT id FROM messages WHERE channel_id=?)"),
+    ("message_reads", "channel_id=?")
+]
+# members.message_seq points at messages.seq, every other seq column only orders rows and is reassigned on import
+# messages.seq is kept when importing into an empty messages table, otherwise it's reassigned and members.message_seq remapped
+PRESERVED_SEQ_TABLES={"messages"}
+
 def format_timestamp(timestamp):
     if timestamp:
         return datetime.fromtimestamp(timestamp).strftime("%Y-%m-%d %H:%M:%S")
@@ -146,6 +188,145 @@ def delete_user(username):
     except Exception as e:
         console.print(f"[red]✗ Error deleting user: {e}[/red]")
 
+def open_export_file(path, mode):
+    if path.endswith(".gz"): return gzip.open(path, mode, compresslevel=6)
+    return open(path, mode, buffering=1<<20)
+
+def export_data(path, channel_id=None, batch_size=1000):
+    db=SQLite()
+    if channel_id and not db.exists("channels", {"id": channel_id}):
+        console.print(f"[red]Channel with ID '{channel_id}' not found.[/red]")
+        db.close()
+        return
+    tables=[(table, None if channel_id is None else (where or "0")) for table, where in EXPORT_TABLES]
+    totals={}
+    for table, where in tables:
+        query=f"SELECT COUNT(*) as count FROM {table}"+(f" WHERE {where}" if where else "")
+        if table=="users": query+=" AND id!='0'" if where else " WHERE id!='0'"
+        totals[table]=db.execute(query, (channel_id,)*query.count("?")).fetchone()["count"]
+    exported=0
+    try:
+        with open_export_file(path, "wb") as f, Progress(TextColumn("[bold blue]{task.description}"), BarColumn(), MofNCompleteColumn(), TimeElapsedColumn(), console=console) as progress:
+            f.write(json.dumps({"sova_export": EXPORT_FORMAT, "version": version, "db": db_version, "channel": channel_id, "exported_at": int(time.time())}).encode()+b"\n")
+            for table, where in tables:
+                task=progress.add_task(table, total=totals[table])
+                query=f"SELECT * FROM {table}"+(f" WHERE {where}" if where else "")
+                if table=="users": query+=" AND id!='0'" if where else " WHERE id!='0'"
+                cursor=db.execute(query+" ORDER BY rowid", (channel_id,)*query.count("?"))
+                while True:
+                    rows=cursor.fetchmany(batch_size)
+                    if not rows: break
+                    f.write(b"".join(json.dumps({"t": table, "r": dict(row)}, separators=(",", ":")).encode()+b"\n" for row in rows))
+                    progress.advance(task, len(rows))
+                    exported+=len(rows)
+    finally:
+        db.close()
+    console.print(f"[green]✓ Exported {exported} rows to '{path}'.[/green]")
+    console.print("[dim]Attachment and profile picture files are not included, copy the data directories alongside the export.[/dim]")
+
+def import_data(path, batch_size=1000):
+    if not os.path.isfile(path):
+        console.print(f"[red]File '{path}' not found.[/red]")
+        return
+    logging.getLogger("db").setLevel(logging.CRITICAL)
+    raw=open(path, "rb", buffering=1<<20)
+    f=gzip.GzipFile(fileobj=raw) if path.endswith(".gz") else raw
+    db=SQLite()
+    table_columns={table: {col["name"] for col in db.get_table_info(table)} for table, _ in EXPORT_TABLES}
+    imported=skipped=0
+    # Kept seqs could collide with existing messages, which INSERT OR IGNORE would silently drop along with their attachments and pins
+    preserve_seq=not db.execute_raw_sql("SELECT 1 AS found FROM messages LIMIT 1")
+    members_start=db.execute_raw_sql("SELECT COALESCE(MAX(seq), 0) AS seq FROM members")[0]["seq"]
+    if not preserve_seq: db.execute_raw_sql("CREATE TEMP TABLE import_seqs (channel_id TEXT NOT NULL, old_seq INTEGER NOT NULL, new_seq INTEGER NOT NULL, PRIMARY KEY (channel_id, old_seq))")
+    def flush(table, columns, rows, seqs):
+        nonlocal imported, skipped
+        insert_sql=f"INSERT OR IGNORE INTO {table} ({', '.join(columns)}) VALUES ({', '.join(['?']*len(columns))})"
+        try:
+            inserted=db.execute_many(insert_sql, rows)
+        except sqlite3.IntegrityError:
+            db.rollback()
+            inserted=0
+            for row in rows:
+                try: inserted+=db.execute_many(insert_sql, [row])
+                except sqlite3.IntegrityError: pass
+        # Old seq -> the seq the message has now, whether it was just inserted or already existed
+        if seqs: db.execute_many("INSERT OR IGNORE INTO temp.import_seqs (channel_id, old_seq, new_seq) SELECT channel_id, ?, seq FROM messages WHERE id=?", seqs)
+        db.commit()
+        imported+=inserted
+        skipped+=len(rows)-inserted
+    try:
+        header=json.loads(f.readline() or b"{}")
+        if header.get("sova_export")!=EXPORT_FORMAT:
+            console.print("[red]Not a Sova export file.[/red]")
+            return
+        if header.get("db")!=db_version:
+            console.print(f"[red]Export database version {header.get('db')} doesn't match this instance ({db_version}), run it with the matching Sova version first.[/red]")
+            return
+        with Progress(TextColumn("[bold blue]{task.description}"), BarColumn(), DownloadColumn(), TimeElapsedColumn(), console=console) as progress:
+            task=progress.add_task("import", total=os.path.getsize(path))
+            table=columns=None
+            rows=[]
+            seqs=[]
+            for line in f:
+                if not line.strip(): continue
+                record=json.loads(line)
+                row=record["r"]
+                seq=row.pop("seq", None) if record["t"] not in PRESERVED_SEQ_TABLES or not preserve_seq else None
+                if record["t"]!=table or tuple(row)!=columns:
+                    if rows: flush(table, columns, rows, seqs)
+                    table, columns, rows, seqs=record["t"], tuple(row), [], []
+                    if table not in table_columns or not set(columns)<=table_columns[table]: raise ValueError(f"Unexpected table or columns in export: {table}")
+                    progress.update(task, description=table)
+                rows.append(tuple(row.values()))
+                if table=="messages" and seq is not None: seqs.append((seq, row["id"]))
+                if len(rows)>=batch_size:
+                    flush(table, columns, rows, seqs)
+                    rows, seqs=[], []
+                    progress.update(task, completed=raw.tell())
+            if rows: flush(table, columns, rows, seqs)
+            # Imported members still hold the exported message_seq, move it to the reassigned seq of the same message
+            if not preserve_seq: db.execute_raw_sql("UPDATE members SET message_seq=COALESCE((SELECT new_seq FROM temp.import_seqs s WHERE s.channel_id=members.channel_id AND s.old_seq<=members.message_seq ORDER BY s.old_seq DESC LIMIT 1), (SELECT MIN(new_seq)-1 FROM temp.import_seqs s WHERE s.channel_id=members.channel_id), (SELECT MAX(seq) FROM messages WHERE channel_id=members.channel_id), 0) WHERE seq>? AND message_seq>0", (members_start,))
+            progress.update(task, completed=raw.tell())
+    finally:
+        f.close()
+        raw.close()
+        db.close()
+    console.print(f"[green]✓ Imported {imported} rows from '{path}'.[/green]")
+    if skipped: console.print(f"[yellow]Skipped {skipped} rows that already exist or reference missing data.[/yellow]")
+
+def backup():
+    with Progress(TextColumn("[bold blue]{task.description}"), BarColumn(), MofNCompleteColumn(), TimeElapsedColumn(), console=console) as progress:
+        task=progress.add_task("database pages", total=None)
+        def step(status, remaining, total): progress.update(task, total=total, completed=total-remaining)
+        path=create_backup(step)
+    console.print(f"[green]✓ Backup written to '{path}'.[/green]")
+    console.print(f"[dim]{len(list_backups())} backup(s) kept[/dim]")
+
+def migrate_files():
+    """Move pfps and attachments from the old flat layout into fan-out directories, safe to run while the server is serving them"""
+    moved=0
+    with Progress(TextColumn("[bold blue]{task.description}"), BarColumn(), MofNCompleteColumn(), TimeElapsedColumn(), console=console) as progress:
+        for file_type in ("pfp", "attachment"):
+            directory=storage_dir(file_type)
+            if not os.path.isdir(directory): continue
+            names=[entry.name for entry in os.scandir(directory) if entry.is_file() and not entry.name.startswith("temp_")]
+            task=progress.add_task(f"{file_type}s", total=len(names))
+            for name in names:
+                file_id=name.removesuffix(".webp") if file_type=="pfp" else name
+                # Names that aren't stored ids or are too short to fan out stay where they are
+                if (file_type=="pfp" and not name.endswith(".webp")) or len(file_id)<2:
+                    progress.advance(task)
+                    continue
+                dest=stored_file_path(file_type, file_id)
+                os.makedirs(os.path.dirname(dest), exist_ok=True)
+                # Renames are atomic, the server finds the file at one of the two paths the whole time
+                try:
+                    os.rename(os.path.join(directory, name), dest)
+                    moved+=1
+                except FileNotFoundError: pass
+                progress.advance(task)
+    console.print(f"[green]✓ Moved {moved} file(s) into the fan-out layout.[/green]")
+
 def show_help():
     help_text=Text()
     help_text.append("Parley Chat Sova CLI - User & Channel Management\n\n", style="bold cyan")
@@ -160,6 +341,20 @@ def show_help():
     help_text.append("Delete a channel by ID\n\n")
     help_text.append("  delete-user <name>  ", style="green")
     help_text.append("Delete a user by username\n\n")
+    help_text.append("  export <file>       ", style="green")
+    help_text.append("Export channels, members, messages, keys and attachment metadata as NDJSON (.gz to compress)\n")
+    help_text.append("    --channel ID      ", style="dim")
+    help_text.append("Only export a single channel\n", style="dim")
+    help_text.append("    --batch-size N    ", style="dim")
+    help_text.append("Rows per batch (default: 1000)\n\n", style="dim")
+    help_text.append("  import <file>       ", style="green")
+    help_text.append("Import an export file, rows that already exist are skipped\n")
+    help_text.append("    --batch-size N    ", style="dim")
+    help_text.append("Rows per batch (default: 1000)\n\n", style="dim")
+    help_text.append("  backup              ", style="green")
+    help_text.append("Back up the database and snapshot pfps and attachments while the server keeps running\n\n")
+    help_text.append("  migrate-files       ", style="green")
+    help_text.append("Move pfps and attachments stored by older versions into fan-out directories, the server can keep running\n\n")
     help_text.append("  help                ", style="green")
     help_text.append("Show this help message\n\n")
     help_text.append("Examples:\n", style="bold")
@@ -167,6 +362,10 @@ def show_help():
     help_text.append("  docker compose run --rm sova python cli.py list-users --page 2\n", style="dim")
     help_text.append("  docker compose run --rm sova python cli.py delete-channel ch_abc123\n", style="dim")
     help_text.append("  docker compose run --rm sova python cli.py delete-user john_doe\n", style="dim")
+    help_text.append("  docker compose run --rm sova python cli.py backup\n", style="dim")
+    help_text.append("  docker compose run --rm sova python cli.py migrate-files\n", style="dim")
+    help_text.append("  docker compose run --rm sova python cli.py export data/export.ndjson.gz\n", style="dim")
+    help_text.append("  docker compose run --rm sova python cli.py import data/export.ndjson.gz\n", style="dim")
     console.print(Panel(help_text, title="Help", border_style="cyan", box=box.ROUNDED))
 
 def main():
@@ -178,6 +377,8 @@ def main():
     parser.add_argument("argument", nargs="?", help="Command argument")
     parser.add_argument("--page", type=int, default=1, help="Page number for list-users")
     parser.add_argument("--per-page", type=int, default=20, help="Items per page for list-users")
+    parser.add_argument("--channel", help="Channel ID for export")
+    parser.add_argument("--batch-size", type=int, default=1000, help="Rows per batch for export and import")
     args=parser.parse_args()
     try:
         if args.command=="list-users":
@@ -194,6 +395,22 @@ def main():
                 console.print("Usage: delete-user <username>")
                 sys.exit(1)
             delete_user(args.argument)
+        elif args.command=="export":
+            if not args.argument:
+                console.print("[red]Error: Output file required[/red]")
+                console.print("Usage: export <file> [--channel <channel_id>]")
+                sys.exit(1)
+            export_data(args.argument, channel_id=args.channel, batch_size=args.batch_size)
+        elif args.command=="import":
+            if not args.argument:
+                console.print("[red]Error: Input file required[/red]")
+                console.print("Usage: import <file>")
+                sys.exit(1)
+            import_data(args.argument, batch_size=args.batch_size)
+        elif args.command=="backup":
+            backup()
+        elif args.command=="migrate-files":
+            migrate_files()
         elif args.command=="help":
             show_help()
         else:
@@ -6,11 +6,14 @@ import hashlib
 import time
 import math
 from typing import List, Dict, Any, Union, Tuple, Optional
-from utils import config
+from utils import config, find_stored_file, storage_dir
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger=logging.getLogger(__name__)
 
+# Called with the ids cleanup_unused_files removed, so in-memory caches of those files can drop them
+file_cleanup_hooks=[]
+
 class SQLite:
     def __init__(self, db_path: str=config["data_dir"]["database"]):
         self.db_path=db_path
@@ -70,6 +73,15 @@ class SQLite:
             logger.error(f"Database Error executing SQL: '{sql_query}' with params {params}. Error: {e}")
             raise
 
+    def execute_many(self, sql_query: str, params_seq: List[Union[Tuple, List]]) -> int:
+        self._connect()
+        try:
+            self._cursor.executemany(sql_query, params_seq)
+            return self._cursor.rowcount
+        except sqlite3.Error as e:
+            logger.error(f"Database Error executing batch SQL: '{sql_query}' with {len(params_seq)} rows. Error: {e}")
+            raise
+
     def commit(self) -> None:
         if self._conn:
             try:
@@ -81,6 +93,10 @@ class SQLite:
         else:
             logger.warning("No active connection to commit.")
 
+    def rollback(self) -> None:
+        if self._conn:
+            self._conn.rollback()
+
     def close(self) -> None:
         if self._conn:
             self._conn.close()
@@ -117,6 +133,27 @@ class SQLite:
         except sqlite3.Error:
             return False
 
+    def create_virtual_table(self, table_name: str, module: str, arguments: List[str]) -> bool:
+        create_sql=f"CREATE VIRTUAL TABLE IF NOT EXISTS {table_name} USING {module}({', '.join(arguments)})"
+        try:
+            self.execute(create_sql)
+            if not self._in_context:
+                self.commit()
+            return True
+        except sqlite3.Error:
+            return False
+
+    def create_trigger(self, trigger_name: str, event: str, table_name: str, body: str, when: Optional[str]=None) -> bool:
+        when_str=f" WHEN {when}" if when else ""
+        trigger_sql=f"CREATE TRIGGER IF NOT EXISTS {trigger_name} {event} ON {table_name}{when_str} BEGIN {body}; END"
+        try:
+            self.execute(trigger_sql)
+            if not self._in_context:
+                self.commit()
+            return True
+        except sqlite3.Error:
+            return False
+
     def add_column(self, table_name: str, column_name: str, column_type: str, default_value: Optional[Any]=None) -> bool:
         column_def=f"{column_name} {column_type}"
         if default_value is not None:
@@ -358,6 +395,7 @@ class SQLite:
                 WHERE f.id NOT IN (SELECT file_id FROM attachment_message WHERE file_id IS NOT NULL)
                 AND f.id NOT IN (SELECT pfp FROM users WHERE pfp IS NOT NULL)
                 AND f.id NOT IN (SELECT pfp FROM channels WHERE pfp IS NOT NULL)
+                AND f.id NOT IN (SELECT file_id FROM uploads WHERE file_id IS NOT NULL)
             """)
             if not unused_files: return
             file_ids=[f["id"] for f in unused_files]
@@ -369,21 +407,19 @@ class SQLite:
                     WHERE f.id NOT IN (SELECT file_id FROM attachment_message WHERE file_id IS NOT NULL)
                     AND f.id NOT IN (SELECT pfp FROM users WHERE pfp IS NOT NULL)
                     AND f.id NOT IN (SELECT pfp FROM channels WHERE pfp IS NOT NULL)
+                    AND f.id NOT IN (SELECT file_id FROM uploads WHERE file_id IS NOT NULL)
                 """)
                 if not unused_files: return
                 file_ids=[f["id"] for f in unused_files]
                 self.execute(f"DELETE FROM files WHERE id IN ({",".join(["?"] * len(file_ids))})", file_ids)
         for file_record in unused_files:
             file_type=file_record["file_type"]
-            if file_type=="attachment":
-                file_path=os.path.join(config["data_dir"]["attachments"], file_record["id"])
-            elif file_type=="pfp":
-                file_path=os.path.join(config["data_dir"]["pfps"], f"{file_record['id']}.webp")
-            else:
-                continue
-            if os.path.isfile(file_path):
+            if file_type not in ("attachment", "pfp"): continue
+            file_path=find_stored_file(file_type, file_record["id"])
+            if file_path:
                 try: os.remove(file_path)
                 except OSError as e: logger.error(f"Failed to remove {file_type} file {file_record['id']}: {e}")
+        for hook in file_cleanup_hooks: hook(file_ids)
 
     def cleanup_unused_keys(self):
         """Remove keys that are no longer referenced by any messages"""
@@ -409,14 +445,28 @@ class SQLite:
                     WHERE id NOT IN (SELECT key_id FROM channels_keys_info)
                 """)
 
+    def cleanup_expired_uploads(self):
+        """Remove expired upload sessions, and partial upload files whose session is gone"""
+        with self: expired=self.execute("DELETE FROM uploads WHERE expires_at<? RETURNING file_id", (math.floor(time.time()),)).fetchall()
+        directory=storage_dir("attachment")
+        # Listed before the sessions are read, a partial file is only ever created after its session
+        names=[entry.name for entry in os.scandir(directory) if entry.name.startswith("temp_upload_")] if os.path.isdir(directory) else []
+        pending={row["id"] for row in self.execute_raw_sql("SELECT id FROM uploads WHERE file_id IS NULL")}
+        for name in names:
+            if name.removeprefix("temp_upload_") in pending: continue
+            try: os.remove(os.path.join(directory, name))
+            except OSError: pass
+        if any(row["file_id"] for row in expired): self.cleanup_unused_files()
+
+    def cleanup_channel_changes(self, retention: int):
+        """Drop change log records older than retention seconds, /sync tells clients whose cursor is behind them to reload"""
+        self.execute_raw_sql("DELETE FROM channel_changes WHERE at<?", (math.floor(time.time()*1000)-retention*1000,))
+
     def calculate_file_hash(self, file_path: str) -> str:
         """Calculate SHA256 hash of a file"""
-        hash_sha256=hashlib.sha256()
         try:
             with open(file_path, "rb") as f:
-                for chunk in iter(lambda: f.read(4096), b""):
-                    hash_sha256.update(chunk)
-            return hash_sha256.hexdigest()
+                return hashlib.file_digest(f, "sha256").hexdigest()
         except IOError as e:
             logger.error(f"Failed to calculate hash for {file_path}: {e}")
             raise
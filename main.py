@@ -1,62 +1,35 @@
-import os, sys
+import os, sys, time, unicodedata
+from urllib.parse import quote
+startup_started=time.perf_counter()
 os.chdir(os.path.dirname(os.path.abspath(sys.argv[0])) if getattr(sys, "frozen", False) else os.path.dirname(os.path.abspath(__file__)))
-from utils import stopping, db_version, dev_mode, config, BLUE, YELLOW, RED, colored_log
+from utils import stopping, db_version, dev_mode, config, BLUE, YELLOW, RED, colored_log, find_stored_file, storage_dir
 os.makedirs(os.path.dirname(config["data_dir"]["database"]), exist_ok=True)
-from flask import Flask, send_from_directory, abort, request, jsonify, redirect, make_response
+from flask import Flask, send_from_directory, send_file, abort, request, jsonify, redirect, make_response, Response
+# Started before anything else starts a thread, its worker processes are forked and forking a multi-threaded process can deadlock them
+if config["messages"]["verify_signatures"]:
+    from api.signatures import start_signature_verifier
+    start_signature_verifier()
 from api import api_bp
-from api.utils import make_json_error, pass_db, process_cors_headers
+from api.utils import make_json_error, pass_db, process_cors_headers, UploadRequest, cleaner, pfp_cache, read_cursors, read_cursor_flusher
+from api.state import challenges
 from werkzeug.utils import safe_join
 from db import SQLite
 from migrations import run_migrations
-import sys
+from schema import ensure_schema
+from threading import Thread
 
 try: run_migrations()
 except Exception as e:
     colored_log(RED, "ERROR", f"Migration failed: {e}")
     sys.exit(1)
 
-with SQLite() as db:
-    db.create_table("users", {"seq": "INTEGER PRIMARY KEY AUTOINCREMENT", "id": "TEXT UNIQUE NOT NULL", "username": "TEXT UNIQUE NOT NULL", "display_name": "TEXT", "pfp": "TEXT", "passkey": "TEXT NOT NULL", "public_key": "TEXT NOT NULL", "created_at": "INTEGER NOT NULL", "FOREIGN KEY (pfp)": "REFERENCES files (id) ON DELETE SET NULL"})
-    db.create_table("session", {"seq": "INTEGER PRIMARY KEY AUTOINCREMENT", "user": "TEXT NOT NULL", "token_hash": "TEXT UNIQUE NOT NULL", "id": "TEXT UNIQUE NOT NULL", "device": "TEXT", "browser": "TEXT", "logged_in_at": "INTEGER NOT NULL", "next_challenge": "INTEGER", "FOREIGN KEY (user)": "REFERENCES users (id) ON DELETE CASCADE"})
-    db.create_table("channels", {"id": "TEXT PRIMARY KEY", "name": "TEXT", "pfp": "TEXT", "type": "INTEGER NOT NULL CHECK (type IN (1, 2, 3))", "permissions": "INTEGER NOT NULL DEFAULT 0", "dm": "TEXT", "invite_code": "TEXT UNIQUE", "created_at": "INTEGER NOT NULL", "FOREIGN KEY (pfp)": "REFERENCES files (id) ON DELETE SET NULL"})
-    db.create_table("members", {"seq": "INTEGER PRIMARY KEY AUTOINCREMENT", "user_id": "TEXT", "channel_id": "TEXT", "joined_at": "INTEGER NOT NULL", "permissions": "INTEGER", "message_seq": "INTEGER DEFAULT 0", "hidden": "INTEGER CHECK (hidden IS NULL OR hidden = 1)", "UNIQUE": "(user_id, channel_id)", "FOREIGN KEY (user_id)": "REFERENCES users (id) ON DELETE CASCADE", "FOREIGN KEY (channel_id)": "REFERENCES channels (id) ON DELETE CASCADE"})
-    db.create_table("messages", {"seq": "INTEGER PRIMARY KEY AUTOINCREMENT", "id": "TEXT UNIQUE NOT NULL", "channel_id": "TEXT NOT NULL", "user_id": "TEXT NOT NULL", "content": "TEXT NOT NULL", "key": "TEXT", "iv": "TEXT", "timestamp": "INTEGER NOT NULL", "edited_at": "INTEGER", "replied_to": "TEXT", "signature": "TEXT", "signed_timestamp": "INTEGER", "nonce": "TEXT", "webhook_id": "TEXT", "webhook_name": "TEXT", "webhook_pfp": "TEXT", "FOREIGN KEY (channel_id)": "REFERENCES channels (id) ON DELETE CASCADE", "FOREIGN KEY (user_id)": "REFERENCES users (id) ON DELETE CASCADE"})
-    db.create_table("message_pins", {"seq": "INTEGER PRIMARY KEY AUTOINCREMENT", "id": "TEXT UNIQUE NOT NULL", "FOREIGN KEY (id)": "REFERENCES messages (id) ON DELETE CASCADE"})
-    db.create_table("files", {"id": "TEXT PRIMARY KEY", "filename": "TEXT", "hash": "TEXT NOT NULL", "size": "INTEGER NOT NULL", "mimetype": "TEXT", "file_type": "TEXT NOT NULL CHECK (file_type IN ('attachment', 'pfp'))", "UNIQUE": "(hash, file_type)"})
-    db.create_table("attachment_message", {"file_id": "TEXT NOT NULL", "message_id": "TEXT NOT NULL", "encrypted": "INTEGER NOT NULL DEFAULT 0", "iv": "TEXT", "PRIMARY KEY": "(file_id, message_id)", "FOREIGN KEY (file_id)": "REFERENCES files (id) ON DELETE CASCADE", "FOREIGN KEY (message_id)": "REFERENCES messages (id) ON DELETE CASCADE"})
-    db.create_table("channels_keys", {"id": "TEXT NOT NULL", "channel_id": "TEXT", "user_id": "TEXT", "key": "TEXT", "FOREIGN KEY (channel_id)": "REFERENCES channels (id) ON DELETE CASCADE", "FOREIGN KEY (user_id)": "REFERENCES users (id) ON DELETE CASCADE"})
-    db.create_table("channels_keys_info", {"seq": "INTEGER PRIMARY KEY AUTOINCREMENT", "key_id": "TEXT UNIQUE NOT NULL", "channel_id": "TEXT", "by": "TEXT", "timestamp": "INTEGER NOT NULL", "expires_at": "INTEGER NOT NULL", "FOREIGN KEY (channel_id)": "REFERENCES channels (id) ON DELETE CASCADE", "FOREIGN KEY (by)": "REFERENCES users (id) ON DELETE SET NULL"})
-    db.create_table("message_reads", {"seq": "INTEGER PRIMARY KEY AUTOINCREMENT", "user_id": "TEXT NOT NULL", "channel_id": "TEXT NOT NULL", "last_message_id": "TEXT NOT NULL", "read_at": "INTEGER NOT NULL", "UNIQUE": "(user_id, channel_id)", "FOREIGN KEY (user_id)": "REFERENCES users (id) ON DELETE CASCADE", "FOREIGN KEY (channel_id)": "REFERENCES channels (id) ON DELETE CASCADE", "FOREIGN KEY (last_message_id)": "REFERENCES messages (id) ON DELETE CASCADE"})
-    db.create_table("bans", {"seq": "INTEGER PRIMARY KEY AUTOINCREMENT", "user_id": "TEXT NOT NULL", "channel_id": "TEXT NOT NULL", "banned_by": "TEXT NOT NULL", "banned_at": "INTEGER NOT NULL", "reason": "TEXT", "UNIQUE": "(user_id, channel_id)", "FOREIGN KEY (user_id)": "REFERENCES users (id) ON DELETE CASCADE", "FOREIGN KEY (channel_id)": "REFERENCES channels (id) ON DELETE CASCADE", "FOREIGN KEY (banned_by)": "REFERENCES users (id) ON DELETE CASCADE"})
-    db.create_table("blocks", {"seq": "INTEGER PRIMARY KEY AUTOINCREMENT", "blocker_id": "TEXT NOT NULL", "blocked_id": "TEXT NOT NULL", "blocked_at": "INTEGER NOT NULL", "UNIQUE": "(blocker_id, blocked_id)", "FOREIGN KEY (blocker_id)": "REFERENCES users (id) ON DELETE CASCADE", "FOREIGN KEY (blocked_id)": "REFERENCES users (id) ON DELETE CASCADE"})
-    db.create_table("calls", {"channel_id": "TEXT PRIMARY KEY", "started_by": "TEXT NOT NULL", "started_at": "INTEGER NOT NULL", "FOREIGN KEY (channel_id)": "REFERENCES channels (id) ON DELETE CASCADE", "FOREIGN KEY (started_by)": "REFERENCES users (id) ON DELETE CASCADE"})
-    db.create_table("call_participants", {"channel_id": "TEXT NOT NULL", "user_id": "TEXT NOT NULL", "joined_at": "INTEGER NOT NULL", "left_at": "INTEGER", "PRIMARY KEY": "(channel_id, user_id)", "FOREIGN KEY (channel_id)": "REFERENCES calls (channel_id) ON DELETE CASCADE", "FOREIGN KEY (user_id)": "REFERENCES users (id) ON DELETE CASCADE"})
-    db.create_table("webhooks", {"id": "TEXT PRIMARY KEY", "channel_id": "TEXT NOT NULL", "name": "TEXT NOT NULL", "pfp": "TEXT", "token": "TEXT NOT NULL", "created_by": "TEXT", "created_at": "INTEGER NOT NULL", "last_used_at": "INTEGER", "FOREIGN KEY (channel_id)": "REFERENCES channels (id) ON DELETE CASCADE", "FOREIGN KEY (created_by)": "REFERENCES users (id) ON DELETE SET NULL"})
-    db.create_index("session", "user")
-    db.create_index("members", "channel_id")
-    db.create_index("members", "message_seq")
-    db.create_index("messages", "channel_id")
-    db.create_index("messages", "user_id")
-    db.create_index("messages", "timestamp")
-    db.create_index("files", "file_type")
-    db.create_index("attachment_message", "message_id")
-    db.create_index("channels_keys", "id")
-    db.create_index("channels_keys", "channel_id")
-    db.create_index("channels_keys", "user_id")
-    db.create_index("channels_keys_info", "channel_id")
-    db.create_index("message_reads", "user_id")
-    db.create_index("message_reads", "channel_id")
-    db.create_index("call_participants", "channel_id")
-    db.create_index("call_participants", "user_id")
-    db.create_index("webhooks", "channel_id")
-    db.create_index("webhooks", "token", unique=True)
-    if not db.exists("users", {"id": "0"}): db.insert_data("users", {"id": "0", "username": "__parley_webhooks_system_account_do_not_use__", "display_name": "System", "pfp": None, "passkey": "system", "public_key": "system", "created_at": 0})
-    if db.execute_raw_sql("PRAGMA user_version;")[0]["user_version"]!=db_version: db.execute_raw_sql(f"PRAGMA user_version={db_version};")
+if ensure_schema(): colored_log(BLUE, "INFO", "Database schema updated")
 
 uri_prefix="/"+config["uri_prefix"] if config["uri_prefix"] else ""
 def route_rule(rule: str): return uri_prefix+rule
 
 app=Flask(__name__, static_folder=None)
+app.request_class=UploadRequest
 
 if config["server"]["proxy"]:
     from werkzeug.middleware.proxy_fix import ProxyFix
@@ -124,36 +97,92 @@ def api_index():
     process_cors_headers(resp)
     return resp
 
-@app_route("/pfp/<string:pfp>", methods=["GET"])
-@pass_db
-def serve_pfp(db:SQLite, pfp:str):
-    pfp_data=db.select_data("files", ["id", "mimetype"], {"id": pfp, "file_type": "pfp"})
-    if not pfp_data: abort(404)
+stored_file_max_age=31536000
+accel_redirect=config["server"]["accel_redirect"].rstrip("/")
+
+def content_disposition(filename):
+    # Same encoding send_file uses, non ASCII names get an ASCII fallback and an RFC 5987 filename*
     try:
-        resp=send_from_directory(config["data_dir"]["pfps"], f"{pfp_data[0]["id"]}.webp", mimetype=pfp_data[0]["mimetype"], as_attachment=False)
-        process_cors_headers(resp)
-        return resp
-    except:
+        filename.encode("ascii")
+        return {"filename": filename}
+    except UnicodeEncodeError: return {"filename": unicodedata.normalize("NFKD", filename).encode("ascii", "ignore").decode("ascii"), "filename*": f"UTF-8''{quote(filename, safe="!#$&+^`|~")}"}
+
+def send_stored_file(db:SQLite, file_type, file_data, download_name=None):
+    """Send a stored file with its hash as a strong ETag and immutable caching, a file id never changes content.
+    Ranges and conditional requests are answered here, or by nginx with sendfile when server.accel_redirect is set"""
+    path=find_stored_file(file_type, file_data["id"])
+    if not path:
         db.cleanup_unused_files()
         abort(404)
+    if accel_redirect:
+        resp=make_response("", 304 if request.if_none_match.contains(file_data["hash"]) else 200)
+        if resp.status_code==200:
+            resp.headers["X-Accel-Redirect"]=f"{accel_redirect}/{os.path.relpath(path, os.path.dirname(os.path.normpath(storage_dir(file_type)))).replace(os.sep, "/")}"
+            resp.headers["Content-Type"]=file_data["mimetype"] or "application/octet-stream"
+            if download_name: resp.headers.set("Content-Disposition", "attachment", **content_disposition(download_name))
+    else:
+        try: resp=send_file(path, mimetype=file_data["mimetype"], as_attachment=bool(download_name), download_name=download_name, etag=file_data["hash"], max_age=stored_file_max_age)
+        except FileNotFoundError:
+            db.cleanup_unused_files()
+            abort(404)
+    return immutable_response(resp, file_data["hash"])
+
+def immutable_response(resp, file_hash):
+    resp.set_etag(file_hash)
+    resp.cache_control.public=True
+    resp.cache_control.max_age=stored_file_max_age
+    resp.cache_control.immutable=True
+    process_cors_headers(resp)
+    return resp
+
+@app_route("/pfp/<string:pfp>", methods=["GET"])
+def serve_pfp(pfp:str):
+    cached=pfp_cache.get(pfp)
+    if not cached:
+        db=SQLite()
+        try:
+            pfp_data=db.select_data("files", ["id", "hash", "mimetype"], {"id": pfp, "file_type": "pfp"})
+            if not pfp_data: abort(404)
+            if accel_redirect: return send_stored_file(db, "pfp", pfp_data[0])
+            path=find_stored_file("pfp", pfp)
+            if not path:
+                db.cleanup_unused_files()
+                abort(404)
+            with open(path, "rb") as f: cached=(f.read(), pfp_data[0]["hash"], pfp_data[0]["mimetype"])
+        finally: db.close()
+        pfp_cache.put(pfp, cached)
+    data, file_hash, mimetype=cached
+    # The ETag is set first so make_conditional checks If-None-Match and If-Range against the file hash
+    resp=immutable_response(Response(data, mimetype=mimetype), file_hash)
+    return resp.make_conditional(request, accept_ranges=True, complete_length=len(data))
 
 @app_route("/attachment/<string:file_id>", methods=["GET"])
 @pass_db
 def serve_attachment(db:SQLite, file_id:str):
-    file_data=db.select_data("files", ["id", "filename", "mimetype"], {"id": file_id, "file_type": "attachment"})
+    file_data=db.select_data("files", ["id", "hash", "filename", "mimetype"], {"id": file_id, "file_type": "attachment"})
     if not file_data: abort(404)
-    filename=file_data[0]["filename"] or "attachment"
-    try:
-        resp=send_from_directory(config["data_dir"]["attachments"], file_data[0]["id"], mimetype=file_data[0]["mimetype"], as_attachment=True, download_name=filename)
-        process_cors_headers(resp)
-        return resp
-    except:
-        db.cleanup_unused_files()
-        abort(404)
+    return send_stored_file(db, "attachment", file_data[0], file_data[0]["filename"] or "attachment")
 
+# Polled by container health checks and open to anyone, challenge store metrics (a COUNT(*) with sqlite state) are only added in dev mode
 @app_route("/health")
-def health(): return jsonify({"status": "ok"})
-
+def health(): return jsonify({"status": "ok", "challenges": challenges.stats()} if dev_mode else {"status": "ok"})
+
+# Started once the schema is in place, it cleans up tables created above
+Thread(target=cleaner, daemon=True).start()
+Thread(target=read_cursor_flusher, daemon=True).start()
+
+if config["backups"]["enabled"]:
+    from backup import backup_scheduler
+    Thread(target=backup_scheduler, daemon=True).start()
+
+# Heavy modules only some endpoints need, importing any of them at startup slows down container restarts and health checks
+lazy_modules=["PIL", "bcrypt", "cryptography", "rich"]
+startup_budget=2
+startup_time=time.perf_counter()-startup_started
+eager_modules=[module for module in lazy_modules if module in sys.modules]
+if eager_modules: colored_log(YELLOW, "WARNING", f"{", ".join(eager_modules)} imported during startup, import them where they're used instead")
+if startup_time>startup_budget: colored_log(YELLOW, "WARNING", f"Startup took {startup_time:.2f}s, over the {startup_budget}s budget")
+else: colored_log(BLUE, "INFO", f"Started in {startup_time*1000:.0f}ms")
 colored_log(BLUE, "INFO", f"Access instance at http://{config["server"]["host"]}:{config["server"]["port"]}{uri_prefix}/")
 if dev_mode: colored_log(YELLOW, "WARNING", "Dev mode is enabled, please disable this mode if you're running this in production")
 if dev_mode: colored_log(BLUE, "DEV MODE INFO", f"Access instance at http://localhost:{config["server"]["port"]}{uri_prefix}/ for local access")
@@ -166,3 +195,4 @@ except KeyboardInterrupt: pass
 finally:
     colored_log(BLUE, "LOG", "Exiting...")
     stopping.set()
+    read_cursors.flush()
@@ -1,12 +1,12 @@
 import os
 import glob
 from db import SQLite
-from utils import colored_log, BLUE, RED
+from utils import colored_log, db_version, BLUE, RED
 
 def run_migrations():
     with SQLite() as db:
         current_version=db.execute_raw_sql("PRAGMA user_version;")[0]["user_version"]
-        if current_version==0: return current_version
+        if current_version==0 or current_version>=db_version: return current_version
         migration_files=sorted(glob.glob("migrations/*.sql"), key=lambda x: int(os.path.basename(x).split(".")[0]))
         if not migration_files: return current_version
         latest_migration=int(os.path.basename(migration_files[-1]).split(".")[0])
@@ -0,0 +1,42 @@
+-- Migration v12: Per-channel change log for delta sync
+CREATE TABLE IF NOT EXISTS channel_changes (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    channel_id TEXT NOT NULL,
+    message_id TEXT NOT NULL,
+    type TEXT NOT NULL CHECK (type IN ('insert', 'edit', 'delete', 'pin', 'unpin')),
+    at INTEGER NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS idx_channel_changes_channel_id ON channel_changes (channel_id);
+CREATE INDEX IF NOT EXISTS idx_channel_changes_at ON channel_changes (at);
+
+CREATE TRIGGER IF NOT EXISTS channel_changes_insert AFTER INSERT ON messages
+BEGIN
+    INSERT INTO channel_changes (channel_id, message_id, type, at) VALUES (new.channel_id, new.id, 'insert', CAST((julianday('now')-2440587.5)*86400000 AS INTEGER));
+END;
+
+CREATE TRIGGER IF NOT EXISTS channel_changes_edit AFTER UPDATE OF content, iv ON messages
+BEGIN
+    INSERT INTO channel_changes (channel_id, message_id, type, at) VALUES (new.channel_id, new.id, 'edit', CAST((julianday('now')-2440587.5)*86400000 AS INTEGER));
+END;
+
+CREATE TRIGGER IF NOT EXISTS channel_changes_delete AFTER DELETE ON messages
+WHEN EXISTS (SELECT 1 FROM channels WHERE id=old.channel_id)
+BEGIN
+    INSERT INTO channel_changes (channel_id, message_id, type, at) VALUES (old.channel_id, old.id, 'delete', CAST((julianday('now')-2440587.5)*86400000 AS INTEGER));
+END;
+
+CREATE TRIGGER IF NOT EXISTS channel_changes_pin AFTER INSERT ON message_pins
+BEGIN
+    INSERT INTO channel_changes (channel_id, message_id, type, at) SELECT channel_id, id, 'pin', CAST((julianday('now')-2440587.5)*86400000 AS INTEGER) FROM messages WHERE id=new.id;
+END;
+
+CREATE TRIGGER IF NOT EXISTS channel_changes_unpin AFTER DELETE ON message_pins
+BEGIN
+    INSERT INTO channel_changes (channel_id, message_id, type, at) SELECT channel_id, id, 'unpin', CAST((julianday('now')-2440587.5)*86400000 AS INTEGER) FROM messages WHERE id=old.id;
+END;
+
+CREATE TRIGGER IF NOT EXISTS channel_changes_channel_delete AFTER DELETE ON channels
+BEGIN
+    DELETE FROM channel_changes WHERE channel_id=old.id;
+END;
@@ -0,0 +1,37 @@
+-- Migration v13: Message seq in the change log, so /sync can hide changes to messages from before a member joined
+ALTER TABLE channel_changes ADD COLUMN message_seq INTEGER;
+
+-- Earlier deletes can't be matched to a seq anymore, the log starts over and following clients reload their channels
+DELETE FROM channel_changes;
+
+DROP TRIGGER IF EXISTS channel_changes_insert;
+DROP TRIGGER IF EXISTS channel_changes_edit;
+DROP TRIGGER IF EXISTS channel_changes_delete;
+DROP TRIGGER IF EXISTS channel_changes_pin;
+DROP TRIGGER IF EXISTS channel_changes_unpin;
+
+CREATE TRIGGER IF NOT EXISTS channel_changes_insert AFTER INSERT ON messages
+BEGIN
+    INSERT INTO channel_changes (channel_id, message_id, message_seq, type, at) VALUES (new.channel_id, new.id, new.seq, 'insert', CAST((julianday('now')-2440587.5)*86400000 AS INTEGER));
+END;
+
+CREATE TRIGGER IF NOT EXISTS channel_changes_edit AFTER UPDATE OF content, iv ON messages
+BEGIN
+    INSERT INTO channel_changes (channel_id, message_id, message_seq, type, at) VALUES (new.channel_id, new.id, new.seq, 'edit', CAST((julianday('now')-2440587.5)*86400000 AS INTEGER));
+END;
+
+CREATE TRIGGER IF NOT EXISTS channel_changes_delete AFTER DELETE ON messages
+WHEN EXISTS (SELECT 1 FROM channels WHERE id=old.channel_id)
+BEGIN
+    INSERT INTO channel_changes (channel_id, message_id, message_seq, type, at) VALUES (old.channel_id, old.id, old.seq, 'delete', CAST((julianday('now')-2440587.5)*86400000 AS INTEGER));
+END;
+
+CREATE TRIGGER IF NOT EXISTS channel_changes_pin AFTER INSERT ON message_pins
+BEGIN
+    INSERT INTO channel_changes (channel_id, message_id, message_seq, type, at) SELECT channel_id, id, seq, 'pin', CAST((julianday('now')-2440587.5)*86400000 AS INTEGER) FROM messages WHERE id=new.id;
+END;
+
+CREATE TRIGGER IF NOT EXISTS channel_changes_unpin AFTER DELETE ON message_pins
+BEGIN
+    INSERT INTO channel_changes (channel_id, message_id, message_seq, type, at) SELECT channel_id, id, seq, 'unpin', CAST((julianday('now')-2440587.5)*86400000 AS INTEGER) FROM messages WHERE id=old.id;
+END;
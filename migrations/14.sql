@@ -0,0 +1,2 @@
+-- Migration v14: Per-attachment filename, files attached by id keep the name their sender gave
+ALTER TABLE attachment_message ADD COLUMN filename TEXT;
@@ -0,0 +1,2 @@
+-- Migration v15: Per-attachment mimetype, every sender keeps the name and type they gave a deduplicated file
+ALTER TABLE attachment_message ADD COLUMN mimetype TEXT;
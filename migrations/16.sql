@@ -0,0 +1,2 @@
+-- Migration v16: Upload claims, only one worker writes or finalizes an upload at a time
+ALTER TABLE uploads ADD COLUMN writer TEXT;
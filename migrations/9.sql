@@ -0,0 +1,22 @@
+-- Migration v9: Add full-text search for broadcast channel messages
+CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(content, channel_id UNINDEXED, tokenize='unicode61 remove_diacritics 2');
+
+CREATE TRIGGER IF NOT EXISTS messages_fts_insert AFTER INSERT ON messages
+WHEN (SELECT type FROM channels WHERE id=new.channel_id)=3
+BEGIN
+    INSERT INTO messages_fts (rowid, content, channel_id) VALUES (new.seq, new.content, new.channel_id);
+END;
+
+CREATE TRIGGER IF NOT EXISTS messages_fts_update AFTER UPDATE OF content ON messages
+BEGIN
+    UPDATE messages_fts SET content=new.content WHERE rowid=new.seq;
+END;
+
+CREATE TRIGGER IF NOT EXISTS messages_fts_delete AFTER DELETE ON messages
+BEGIN
+    DELETE FROM messages_fts WHERE rowid=old.seq;
+END;
+
+-- Index existing broadcast messages
+INSERT INTO messages_fts (rowid, content, channel_id)
+SELECT m.seq, m.content, m.channel_id FROM messages m JOIN channels c ON c.id=m.channel_id WHERE c.type=3;
@@ -0,0 +1,96 @@
+import hashlib
+import json
+from db import SQLite
+from utils import db_version
+
+tables={
+    "users": {"seq": "INTEGER PRIMARY KEY AUTOINCREMENT", "id": "TEXT UNIQUE NOT NULL", "username": "TEXT UNIQUE NOT NULL", "display_name": "TEXT", "pfp": "TEXT", "passkey": "TEXT NOT NULL", "public_key": "TEXT NOT NULL", "created_at": "INTEGER NOT NULL", "FOREIGN KEY (pfp)": "REFERENCES files (id) ON DELETE SET NULL"},
+    "session": {"seq": "INTEGER PRIMARY KEY AUTOINCREMENT", "user": "TEXT NOT NULL", "token_hash": "TEXT UNIQUE NOT NULL", "id": "TEXT UNIQUE NOT NULL", "device": "TEXT", "browser": "TEXT", "logged_in_at": "INTEGER NOT NULL", "next_challenge": "INTEGER", "FOREIGN KEY (user)": "REFERENCES users (id) ON DELETE CASCADE"},
+    "channels": {"id": "TEXT PRIMARY KEY", "name": "TEXT", "pfp": "TEXT", "type": "INTEGER NOT NULL CHECK (type IN (1, 2, 3))", "permissions": "INTEGER NOT NULL DEFAULT 0", "dm": "TEXT", "invite_code": "TEXT UNIQUE", "created_at": "INTEGER NOT NULL", "FOREIGN KEY (pfp)": "REFERENCES files (id) ON DELETE SET NULL"},
+    "members": {"seq": "INTEGER PRIMARY KEY AUTOINCREMENT", "user_id": "TEXT", "channel_id": "TEXT", "joined_at": "INTEGER NOT NULL", "permissions": "INTEGER", "message_seq": "INTEGER DEFAULT 0", "hidden": "INTEGER CHECK (hidden IS NULL OR hidden = 1)", "UNIQUE": "(user_id, channel_id)", "FOREIGN KEY (user_id)": "REFERENCES users (id) ON DELETE CASCADE", "FOREIGN KEY (channel_id)": "REFERENCES channels (id) ON DELETE CASCADE"},
+    "messages": {"seq": "INTEGER PRIMARY KEY AUTOINCREMENT", "id": "TEXT UNIQUE NOT NULL", "channel_id": "TEXT NOT NULL", "user_id": "TEXT NOT NULL", "content": "TEXT NOT NULL", "key": "TEXT", "iv": "TEXT", "timestamp": "INTEGER NOT NULL", "edited_at": "INTEGER", "replied_to": "TEXT", "signature": "TEXT", "signed_timestamp": "INTEGER", "nonce": "TEXT", "webhook_id": "TEXT", "webhook_name": "TEXT", "webhook_pfp": "TEXT", "verified": "INTEGER", "FOREIGN KEY (channel_id)": "REFERENCES channels (id) ON DELETE CASCADE", "FOREIGN KEY (user_id)": "REFERENCES users (id) ON DELETE CASCADE"},
+    "message_pins": {"seq": "INTEGER PRIMARY KEY AUTOINCREMENT", "id": "TEXT UNIQUE NOT NULL", "FOREIGN KEY (id)": "REFERENCES messages (id) ON DELETE CASCADE"},
+    "files": {"id": "TEXT PRIMARY KEY", "filename": "TEXT", "hash": "TEXT NOT NULL", "size": "INTEGER NOT NULL", "mimetype": "TEXT", "file_type": "TEXT NOT NULL CHECK (file_type IN ('attachment', 'pfp'))", "UNIQUE": "(hash, file_type)"},
+    "attachment_message": {"file_id": "TEXT NOT NULL", "message_id": "TEXT NOT NULL", "encrypted": "INTEGER NOT NULL DEFAULT 0", "iv": "TEXT", "filename": "TEXT", "mimetype": "TEXT", "PRIMARY KEY": "(file_id, message_id)", "FOREIGN KEY (file_id)": "REFERENCES files (id) ON DELETE CASCADE", "FOREIGN KEY (message_id)": "REFERENCES messages (id) ON DELETE CASCADE"},
+    "channels_keys": {"id": "TEXT NOT NULL", "channel_id": "TEXT", "user_id": "TEXT", "key": "TEXT", "FOREIGN KEY (channel_id)": "REFERENCES channels (id) ON DELETE CASCADE", "FOREIGN KEY (user_id)": "REFERENCES users (id) ON DELETE CASCADE"},
+    "channels_keys_info": {"seq": "INTEGER PRIMARY KEY AUTOINCREMENT", "key_id": "TEXT UNIQUE NOT NULL", "channel_id": "TEXT", "by": "TEXT", "timestamp": "INTEGER NOT NULL", "expires_at": "INTEGER NOT NULL", "FOREIGN KEY (channel_id)": "REFERENCES channels (id) ON DELETE CASCADE", "FOREIGN KEY (by)": "REFERENCES users (id) ON DELETE SET NULL"},
+    "message_reads": {"seq": "INTEGER PRIMARY KEY AUTOINCREMENT", "user_id": "TEXT NOT NULL", "channel_id": "TEXT NOT NULL", "last_message_id": "TEXT NOT NULL", "read_at": "INTEGER NOT NULL", "UNIQUE": "(user_id, channel_id)", "FOREIGN KEY (user_id)": "REFERENCES users (id) ON DELETE CASCADE", "FOREIGN KEY (channel_id)": "REFERENCES channels (id) ON DELETE CASCADE", "FOREIGN KEY (last_message_id)": "REFERENCES messages (id) ON DELETE CASCADE"},
+    "bans": {"seq": "INTEGER PRIMARY KEY AUTOINCREMENT", "user_id": "TEXT NOT NULL", "channel_id": "TEXT NOT NULL", "banned_by": "TEXT NOT NULL", "banned_at": "INTEGER NOT NULL", "reason": "TEXT", "UNIQUE": "(user_id, channel_id)", "FOREIGN KEY (user_id)": "REFERENCES users (id) ON DELETE CASCADE", "FOREIGN KEY (channel_id)": "REFERENCES channels (id) ON DELETE CASCADE", "FOREIGN KEY (banned_by)": "REFERENCES users (id) ON DELETE CASCADE"},
+    "blocks": {"seq": "INTEGER PRIMARY KEY AUTOINCREMENT", "blocker_id": "TEXT NOT NULL", "blocked_id": "TEXT NOT NULL", "blocked_at": "INTEGER NOT NULL", "UNIQUE": "(blocker_id, blocked_id)", "FOREIGN KEY (blocker_id)": "REFERENCES users (id) ON DELETE CASCADE", "FOREIGN KEY (blocked_id)": "REFERENCES users (id) ON DELETE CASCADE"},
+    "calls": {"channel_id": "TEXT PRIMARY KEY", "started_by": "TEXT NOT NULL", "started_at": "INTEGER NOT NULL", "FOREIGN KEY (channel_id)": "REFERENCES channels (id) ON DELETE CASCADE", "FOREIGN KEY (started_by)": "REFERENCES users (id) ON DELETE CASCADE"},
+    "call_participants": {"channel_id": "TEXT NOT NULL", "user_id": "TEXT NOT NULL", "joined_at": "INTEGER NOT NULL", "left_at": "INTEGER", "PRIMARY KEY": "(channel_id, user_id)", "FOREIGN KEY (channel_id)": "REFERENCES calls (channel_id) ON DELETE CASCADE", "FOREIGN KEY (user_id)": "REFERENCES users (id) ON DELETE CASCADE"},
+    "webhooks": {"id": "TEXT PRIMARY KEY", "channel_id": "TEXT NOT NULL", "name": "TEXT NOT NULL", "pfp": "TEXT", "token": "TEXT NOT NULL", "created_by": "TEXT", "created_at": "INTEGER NOT NULL", "last_used_at": "INTEGER", "FOREIGN KEY (channel_id)": "REFERENCES channels (id) ON DELETE CASCADE", "FOREIGN KEY (created_by)": "REFERENCES users (id) ON DELETE SET NULL"},
+    "uploads": {"id": "TEXT PRIMARY KEY", "user_id": "TEXT NOT NULL", "filename": "TEXT NOT NULL", "mimetype": "TEXT", "size": "INTEGER NOT NULL", "received": "INTEGER NOT NULL DEFAULT 0", "encrypted": "INTEGER NOT NULL DEFAULT 0", "iv": "TEXT", "file_id": "TEXT", "created_at": "INTEGER NOT NULL", "expires_at": "INTEGER NOT NULL", "writer": "TEXT", "FOREIGN KEY (user_id)": "REFERENCES users (id) ON DELETE CASCADE", "FOREIGN KEY (file_id)": "REFERENCES files (id) ON DELETE CASCADE"},
+    "channel_changes": {"seq": "INTEGER PRIMARY KEY AUTOINCREMENT", "channel_id": "TEXT NOT NULL", "message_id": "TEXT NOT NULL", "type": "TEXT NOT NULL CHECK (type IN ('insert', 'edit', 'delete', 'pin', 'unpin'))", "at": "INTEGER NOT NULL", "message_seq": "INTEGER"}
+}
+
+virtual_tables=[
+    ("messages_fts", "fts5", ["content", "channel_id UNINDEXED", "tokenize='unicode61 remove_diacritics 2'"])
+]
+
+triggers=[
+    ("messages_fts_insert", "AFTER INSERT", "messages", "INSERT INTO messages_fts (rowid, content, channel_id) VALUES (new.seq, new.content, new.channel_id)", "(SELECT type FROM channels WHERE id=new.channel_id)=3"),
+    ("messages_fts_update", "AFTER UPDATE OF content", "messages", "UPDATE messages_fts SET content=new.content WHERE rowid=new.seq"),
+    ("messages_fts_delete", "AFTER DELETE", "messages", "DELETE FROM messages_fts WHERE rowid=old.seq"),
+    # Change log read by /sync, messages removed with their channel aren't logged and the channel's log goes with it
+    ("channel_changes_insert", "AFTER INSERT", "messages", "INSERT INTO channel_changes (channel_id, message_id, message_seq, type, at) VALUES (new.channel_id, new.id, new.seq, 'insert', CAST((julianday('now')-2440587.5)*86400000 AS INTEGER))"),
+    ("channel_changes_edit", "AFTER UPDATE OF content, iv", "messages", "INSERT INTO channel_changes (channel_id, message_id, message_seq, type, at) VALUES (new.channel_id, new.id, new.seq, 'edit', CAST((julianday('now')-2440587.5)*86400000 AS INTEGER))"),
+    ("channel_changes_delete", "AFTER DELETE", "messages", "INSERT INTO channel_changes (channel_id, message_id, message_seq, type, at) VALUES (old.channel_id, old.id, old.seq, 'delete', CAST((julianday('now')-2440587.5)*86400000 AS INTEGER))", "EXISTS (SELECT 1 FROM channels WHERE id=old.channel_id)"),
+    ("channel_changes_pin", "AFTER INSERT", "message_pins", "INSERT INTO channel_changes (channel_id, message_id, message_seq, type, at) SELECT channel_id, id, seq, 'pin', CAST((julianday('now')-2440587.5)*86400000 AS INTEGER) FROM messages WHERE id=new.id"),
+    ("channel_changes_unpin", "AFTER DELETE", "message_pins", "INSERT INTO channel_changes (channel_id, message_id, message_seq, type, at) SELECT channel_id, id, seq, 'unpin', CAST((julianday('now')-2440587.5)*86400000 AS INTEGER) FROM messages WHERE id=old.id"),
+    ("channel_changes_channel_delete", "AFTER DELETE", "channels", "DELETE FROM channel_changes WHERE channel_id=old.id")
+]
+
+indexes=[
+    ("session", "user"),
+    ("members", "channel_id"),
+    ("members", "message_seq"),
+    ("messages", "channel_id"),
+    ("messages", "user_id"),
+    ("messages", "timestamp"),
+    ("files", "file_type"),
+    ("attachment_message", "message_id"),
+    ("channels_keys", "id"),
+    ("channels_keys", "channel_id"),
+    ("channels_keys", "user_id"),
+    ("channels_keys_info", "channel_id"),
+    ("message_reads", "user_id"),
+    ("message_reads", "channel_id"),
+    ("call_participants", "channel_id"),
+    ("call_participants", "user_id"),
+    ("webhooks", "channel_id"),
+    ("webhooks", "token", True),
+    ("uploads", "user_id"),
+    ("uploads", "expires_at"),
+    ("channel_changes", "channel_id"),
+    ("channel_changes", "at")
+]
+
+def schema_fingerprint():
+    return hashlib.sha256(json.dumps([db_version, tables, virtual_tables, triggers, indexes]).encode()).hexdigest()
+
+def create_schema(db: SQLite, fingerprint: str):
+    for table_name, columns in tables.items(): db.create_table(table_name, columns)
+    for table_name, module, arguments in virtual_tables: db.create_virtual_table(table_name, module, arguments)
+    for trigger in triggers: db.create_trigger(*trigger)
+    for index in indexes: db.create_index(*index)
+    if not db.exists("users", {"id": "0"}): db.insert_data("users", {"id": "0", "username": "__parley_webhooks_system_account_do_not_use__", "display_name": "System", "pfp": None, "passkey": "system", "public_key": "system", "created_at": 0})
+    if db.execute_raw_sql("PRAGMA user_version;")[0]["user_version"]!=db_version: db.execute_raw_sql(f"PRAGMA user_version={db_version};")
+    db.create_table("schema_meta", {"key": "TEXT PRIMARY KEY", "value": "TEXT NOT NULL"})
+    db.execute("INSERT INTO schema_meta (key, value) VALUES ('fingerprint', ?) ON CONFLICT(key) DO UPDATE SET value=excluded.value", (fingerprint,))
+
+def stored_fingerprint(db: SQLite):
+    if not db.exists("sqlite_master", {"type": "table", "name": "schema_meta"}): return None
+    data=db.select_data("schema_meta", ["value"], {"key": "fingerprint"})
+    return data[0]["value"] if data else None
+
+def ensure_schema():
+    """Create tables and indexes unless the database already matches this schema, returns whether DDL ran"""
+    fingerprint=schema_fingerprint()
+    db=SQLite()
+    try:
+        if stored_fingerprint(db)==fingerprint and db.execute_raw_sql("PRAGMA user_version;")[0]["user_version"]==db_version: return False
+    finally:
+        db.close()
+    with SQLite() as db: create_schema(db, fingerprint)
+    return True
@@ -35,4 +35,21 @@ YELLOW="\033[33m"
 RED="\033[31m"
 RESET="\033[0m"
 
-def colored_log(color, tag, text): print(f"{color}[{tag}]{RESET} {text}")
\ No newline at end of file
+def colored_log(color, tag, text): print(f"{color}[{tag}]{RESET} {text}")
+
+def storage_dir(file_type): return config["data_dir"]["attachments" if file_type=="attachment" else "pfps"]
+
+def stored_file_path(file_type, file_id):
+    """Where a stored file lives, fanned out over two directory levels by the first characters of its random id so no directory grows past a few thousand entries"""
+    return os.path.join(storage_dir(file_type), file_id[0], file_id[1], f"{file_id}.webp" if file_type=="pfp" else file_id)
+
+def upload_path(upload_id): return os.path.join(storage_dir("attachment"), f"temp_upload_{upload_id}")
+
+def find_stored_file(file_type, file_id):
+    """Path of a stored file, or None if it doesn't exist. Falls back to the old flat layout for files `cli.py migrate-files` hasn't moved yet"""
+    path=stored_file_path(file_type, file_id)
+    if os.path.isfile(path): return path
+    legacy_path=os.path.join(storage_dir(file_type), os.path.basename(path))
+    if os.path.isfile(legacy_path): return legacy_path
+    # It may have been moved between the two checks
+    return path if os.path.isfile(path) else None
\ No newline at end of file